@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+"""
+Micro benchmarks of the database access of the file system. By default
+they run against an in-memory SQLite database filled with synthetic data,
+the 'sqlite' benchmark uses temporary database files.
+"""
+
+from __future__ import division, unicode_literals, print_function
+
+import os
+import time
+import shutil
+import timeit
+import argparse
+import datetime
+import tempfile
+import threading
+
+import sqlalchemy
+import sqlalchemy.orm as orm
+
+import morphdepot.config as config
+from morphdepot import db
+from morphdepot.db import create_engine, create_session
+from morphdepot.models import Base
+from morphdepot.models.core import Scientist, Experiment, TissueSample
+from morphdepot.fsmapping import children_query
+
+
+def populate(session, scientists, experiments, samples):
+    """
+    Adds scientists with experiments with tissue samples.
+    """
+    date = datetime.datetime(2013, 1, 1)
+    for i in range(scientists):
+        sct = Scientist(first_name="First %i" % i, last_name="Last %i" % i,
+                        author_notation="F. Last %i" % i)
+        session.add(sct)
+        for j in range(experiments):
+            exp = Experiment(label="Exp %i-%i" % (i, j), date=date, scientist=sct)
+            session.add(exp)
+            for k in range(samples):
+                session.add(TissueSample(label="Tissue %i-%i-%i" % (i, j, k), experiment=exp))
+    session.commit()
+
+
+def report(name, seconds, number):
+    print("%-40s %10.1f us/call" % (name, seconds / number * 1e6))
+
+
+def queries(args):
+    """
+    Compares queries that are built and compiled on every call with the
+    baked queries of fsmapping.
+    """
+    session = create_session(create_engine())
+    if session.query(Scientist).count() == 0:
+        populate(session, args.scientists, args.experiments, args.samples)
+    sct = session.query(Scientist).first()
+    exp = session.query(Experiment).first()
+    session.expunge_all()
+
+    def experiments_query():
+        session.query(Experiment).filter(Experiment.scientist_id == sct.id).all()
+        session.expunge_all()
+
+    def experiments_baked():
+        children_query(Experiment, 'scientist_id')(session).params(parent_id=sct.id).all()
+        session.expunge_all()
+
+    def samples_query():
+        session.query(TissueSample).filter(TissueSample.experiment_id == exp.id).all()
+        session.expunge_all()
+
+    def samples_baked():
+        children_query(TissueSample, 'experiment_id')(session).params(parent_id=exp.id).all()
+        session.expunge_all()
+
+    def get_query():
+        session.query(Experiment).get(exp.id)
+        session.expunge_all()
+
+    def get_baked():
+        children_query(Experiment)(session).get(exp.id)
+        session.expunge_all()
+
+    for name, fn in [("experiments of a scientist, query", experiments_query),
+                     ("experiments of a scientist, baked", experiments_baked),
+                     ("tissue samples of an experiment, query", samples_query),
+                     ("tissue samples of an experiment, baked", samples_baked),
+                     ("experiment by id, query", get_query),
+                     ("experiment by id, baked", get_baked)]:
+        fn()
+        report(name, min(timeit.repeat(fn, number=args.number, repeat=3)), args.number)
+
+
+def in_threads(fn, threads):
+    """ runs fn in a number of threads, returns the elapsed seconds """
+    workers = [threading.Thread(target=fn) for i in range(threads)]
+    start = time.time()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    return time.time() - start
+
+
+def sqlite(args):
+    """
+    Compares the SQLite profile of db (WAL, tuned PRAGMAs, a pool of read
+    connections and one writer) with the defaults of SQLAlchemy, on copies
+    of the same database file: concurrent listings, small write
+    transactions, and listings while another thread writes.
+    """
+    tmp = tempfile.mkdtemp()
+    try:
+        template = os.path.join(tmp, 'template.db')
+        engine = sqlalchemy.create_engine('sqlite:///' + template)
+        Base.metadata.create_all(engine)
+        session = orm.sessionmaker(bind=engine)()
+        populate(session, args.scientists, args.experiments, args.samples)
+        scientists = [sct.id for sct in session.query(Scientist)]
+        experiments = [exp.id for exp in session.query(Experiment)]
+        session.close()
+        engine.dispose()
+
+        for profile in ('default', 'profile'):
+            path = os.path.join(tmp, profile + '.db')
+            shutil.copy(template, path)
+            config.DB = dict(config.DB, url='sqlite:///' + path, type='sqlite', echo=False)
+            if profile == 'default':
+                # one connection per session, only foreign keys configured
+                engine = sqlalchemy.create_engine(config.DB['url'])
+                engine.execute("PRAGMA foreign_keys=ON")
+                Session = orm.sessionmaker(bind=engine)
+            else:
+                Session = db.sessionmaker(db.create_engine())
+            query = children_query(Experiment, 'scientist_id')
+
+            def listings():
+                for i in range(args.number):
+                    session = Session()
+                    query(session).params(parent_id=scientists[i % len(scientists)]).all()
+                    session.close()
+
+            def writes():
+                for i in range(args.number):
+                    session = Session()
+                    exp = session.query(Experiment).get(experiments[i % len(experiments)])
+                    exp.label = "%s %i" % (profile, i)
+                    session.commit()
+                    session.close()
+
+            seconds = in_threads(listings, args.threads)
+            report("%s: listings, %i threads" % (profile, args.threads), seconds,
+                   args.number * args.threads)
+            seconds = in_threads(writes, 1)
+            report("%s: write transactions" % profile, seconds, args.number)
+            writer = threading.Thread(target=writes)
+            writer.start()
+            seconds = in_threads(listings, args.threads)
+            writer.join()
+            report("%s: listings while writing" % profile, seconds,
+                   args.number * args.threads)
+    finally:
+        shutil.rmtree(tmp)
+
+
+parser = argparse.ArgumentParser(description="MorphDepot benchmarks")
+parser.add_argument('--url', help="database to use instead of an in-memory SQLite database")
+parser.add_argument('--scientists', type=int, default=10)
+parser.add_argument('--experiments', type=int, default=10, help="per scientist")
+parser.add_argument('--samples', type=int, default=10, help="per experiment")
+parser.add_argument('--uuid-storage', choices=('hex', 'binary'), default='hex',
+                    help="storage of ids on SQLite")
+commands = parser.add_subparsers(dest='command')
+
+cmd = commands.add_parser('queries', help="listing and lookup queries, built vs. baked")
+cmd.add_argument('--number', type=int, default=1000, help="calls per measurement")
+cmd.set_defaults(func=queries)
+
+cmd = commands.add_parser('sqlite', help="SQLite profile of db vs. SQLAlchemy defaults, "
+                                         "on a database file")
+cmd.add_argument('--number', type=int, default=500, help="calls per thread")
+cmd.add_argument('--threads', type=int, default=4, help="reading threads")
+cmd.set_defaults(func=sqlite)
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    config.DB = dict(config.DB, uuid_storage=args.uuid_storage)
+    if args.url:
+        config.DB = dict(config.DB, url=args.url, type=args.url.split(':')[0].split('+')[0])
+    else:
+        config.DB = dict(config.DB, url='sqlite://', type='sqlite', echo=False)
+    args.func(args)
@@ -3,12 +3,11 @@
 from __future__ import division, unicode_literals, print_function
 
 import datetime
-import sqlalchemy
-import sqlalchemy.orm
 
 from morphdepot.log import logged
 
 import morphdepot.config as config
+import morphdepot.db as db
 import morphdepot.models as models
 import morphdepot.models.core as core
 import morphdepot.models.morph as morph
@@ -38,15 +37,9 @@ def db_connect():
     global session
     global connected
     if not connected:
-        engine = sqlalchemy.create_engine(config.DB['url'], echo=config.DB['echo'])
-        if config.DB['type'] == "sqlite":
-            engine.execute("PRAGMA foreign_keys=ON")
-        elif config.DB['type'] == "postgresql" and config.DB['pg_recreate_schema']:
-                engine.execute("DROP SCHEMA %s CASCADE;" % (config.DB['schema']))
-                engine.execute("CREATE SCHEMA %s;" % (config.DB['schema']))
-        Session = sqlalchemy.orm.sessionmaker(bind=engine)
-        Base.metadata.create_all(engine)
-        session = Session()
+        engine = db.create_engine(
+            recreate_schema=config.DB['type'] == "postgresql" and config.DB['pg_recreate_schema'])
+        session = db.sessionmaker(engine)()
         connected = True
 
 
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+
+from __future__ import division, unicode_literals, print_function
+
+import sys
+import argparse
+
+import yaml
+
+from morphdepot.db import create_engine, create_session, migrate_uuids, upgrade_schema
+from morphdepot.aggregates import recount
+from morphdepot import tables
+from morphdepot.rawdata import rehash_files, relayout, collect_tombstones, \
+    update_representation_checksums
+from morphdepot.scrub import scrub
+from morphdepot.ingest import serve
+from morphdepot.models.core import NeuroRepresentation
+
+
+def rehash(args):
+    session = create_session()
+    changed = rehash_files(session, batch_size=args.batch_size)
+    for id, path, checksum in changed:
+        print("%s\t%s" % (checksum, path))
+    print("%i checksum(s) updated" % len(changed))
+
+
+def scrub_files(args):
+    session = create_session()
+    report = scrub(session, full=args.full, processes=args.processes,
+                   rate=args.rate, checkpoint=args.checkpoint)
+    if args.report:
+        with open(args.report, 'w') as f:
+            yaml.safe_dump(report, f, default_flow_style=False)
+    else:
+        yaml.safe_dump(report, sys.stdout, default_flow_style=False)
+    if report['mismatches'] or report['missing'] or report['errors']:
+        sys.exit(1)
+
+
+def relayout_dirs(args):
+    session = create_session()
+    old_fanout = [int(w) for w in args.old_fanout.split(',') if w]
+    moved = relayout(session, old_fanout, threads=args.threads)
+    print("%i directories moved" % moved)
+
+
+def collect(args):
+    session = create_session()
+    removed = collect_tombstones(session, threads=args.threads)
+    print("%i files and directories removed" % removed)
+
+
+def enqueue(args):
+    session = create_session()
+    nr = session.query(NeuroRepresentation).get(args.id)
+    for path in args.paths:
+        nr.enqueue_file(path, args.mode)
+    session.commit()
+
+
+def ingest(args):
+    serve(args.workers)
+
+
+def uuids(args):
+    count = migrate_uuids(create_engine(), args.storage)
+    print("%i id(s) converted, set DB['uuid_storage'] to '%s'" % (count, args.storage))
+
+
+def recount_aggregates(args):
+    recount(create_session())
+    print("aggregates recounted")
+
+
+def check_tables(args):
+    session = create_session()
+    failed = False
+    for model in tables.TABLE_MODELS:
+        for line, message in tables.check_roundtrip(session, model):
+            failed = True
+            print("%s.csv: %s%s" % (tables.table_name(model),
+                                    "line %i: " % line if line else "", message))
+    if failed:
+        sys.exit(1)
+
+
+def upgrade(args):
+    engine = create_engine()
+    added = upgrade_schema(engine)
+    for name in added:
+        print("added %s" % name)
+    session = create_session(engine)
+    if 'neuro_representations._checksum_sum' in added:
+        update_representation_checksums(session)
+        print("representation checksums computed")
+    if any(name.endswith('.byte_count') for name in added):
+        recount(session)
+        print("aggregates recounted")
+
+
+parser = argparse.ArgumentParser(description="MorphDepot maintenance tasks")
+commands = parser.add_subparsers()
+
+cmd = commands.add_parser('upgrade', help="add the columns of newer versions to an existing "
+                                          "database and fill them in")
+cmd.set_defaults(func=upgrade)
+
+cmd = commands.add_parser('rehash', help="recompute all file checksums (after 'upgrade' on "
+                                         "databases of older versions)")
+cmd.add_argument('--batch-size', type=int, default=100)
+cmd.set_defaults(func=rehash)
+
+cmd = commands.add_parser('scrub', help="verify raw data files against their checksums")
+cmd.add_argument('--full', action='store_true',
+                 help="hash files even if size and mtime are unchanged")
+cmd.add_argument('--processes', type=int)
+cmd.add_argument('--rate', type=float, help="maximum read rate in MB/s")
+cmd.add_argument('--checkpoint', help="checkpoint file used to resume a scrub")
+cmd.add_argument('--report', help="write the report to this file")
+cmd.set_defaults(func=scrub_files)
+
+cmd = commands.add_parser('relayout', help="move raw data to the layout configured in RAW_DATA['fanout']")
+cmd.add_argument('old_fanout', help="the current fan-out, e.g. '' (flat) or '2,2'")
+cmd.add_argument('--threads', type=int, default=8)
+cmd.set_defaults(func=relayout_dirs)
+
+cmd = commands.add_parser('collect', help="remove raw data of deleted objects")
+cmd.add_argument('--threads', type=int)
+cmd.set_defaults(func=collect)
+
+cmd = commands.add_parser('enqueue', help="queue files for ingestion into a neuro representation")
+cmd.add_argument('id', help="id of the neuro representation")
+cmd.add_argument('paths', nargs='+')
+cmd.add_argument('--mode', choices=('copy', 'reflink', 'hardlink', 'move'))
+cmd.set_defaults(func=enqueue)
+
+cmd = commands.add_parser('ingest', help="run ingest workers")
+cmd.add_argument('--workers', type=int)
+cmd.set_defaults(func=ingest)
+
+cmd = commands.add_parser('uuids', help="convert the ids of a SQLite database to hex or binary storage")
+cmd.add_argument('storage', choices=('hex', 'binary'))
+cmd.set_defaults(func=uuids)
+
+cmd = commands.add_parser('recount', help="recompute the child counts and sizes of all folders")
+cmd.set_defaults(func=recount_aggregates)
+
+cmd = commands.add_parser('check-tables', help="verify that every table is accepted back unchanged")
+cmd.set_defaults(func=check_tables)
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    args.func(args)
@@ -0,0 +1,235 @@
+"""
+Maintains the aggregates of the objects that are folders of the file system
+(see AggregateMixin): the number of objects listed in the folder of an
+object, and the number and total size of the ready files below it. Every
+flush works out by how much they change from the objects it adds, moves,
+deletes or resizes, and applies the differences up to the scientist as
+increments in SQL, so concurrent transactions do not lose each others
+updates. recount() computes all aggregates from scratch.
+
+"""
+from __future__ import division, unicode_literals, print_function
+
+import sqlalchemy as sa
+import sqlalchemy.orm as orm
+
+from morphdepot import cache
+from morphdepot.models.core import Scientist, Experiment, TissueSample, \
+    NeuroRepresentation, File
+
+# the relationship of a model to the object whose folder lists its objects
+PARENTS = ((File, 'neuro_representation'),
+           (NeuroRepresentation, 'tissue_sample'),
+           (TissueSample, 'experiment'),
+           (Experiment, 'scientist'))
+
+AGGREGATES = ('child_count', 'file_count', 'byte_count')
+
+# keys of session.info between the flush events
+_DELTAS = 'aggregate_deltas'
+_UPDATED = 'aggregate_updated'
+
+
+def _parent_name(obj):
+    for model, name in PARENTS:
+        if isinstance(obj, model):
+            return name
+    return None
+
+
+def _committed(session, obj, key):
+    """ the value of an attribute before the flush """
+    added, unchanged, deleted = sa.inspect(obj).attrs[key].history
+    if deleted:
+        return deleted[0]
+    if unchanged:
+        return unchanged[0]
+    model = type(obj)
+    # set before it was loaded
+    return session.query(getattr(model, key)).filter(model.id == obj.id).scalar()
+
+
+def _parents(session, obj, name):
+    """
+    The parent object of an object before and after the flush, either may
+    be None.
+    """
+    state = sa.inspect(obj)
+    prop = state.mapper.relationships[name]
+    fk = state.mapper.get_property_by_column(list(prop.local_columns)[0]).key
+    model = prop.mapper.class_
+    # the relationship or, if only the id was set, the foreign key
+    rel = state.attrs[name].history
+    ids = state.attrs[fk].history
+
+    old = None
+    if state.has_identity:
+        if rel.deleted and rel.deleted[0] is not None:
+            old = rel.deleted[0]
+        elif rel.unchanged and not rel.added:
+            old = rel.unchanged[0]
+        else:
+            old_id = _committed(session, obj, fk)
+            if old_id is not None:
+                old = session.query(model).get(old_id)
+
+    if obj in session.deleted:
+        new = None
+    elif rel.added:
+        new = rel.added[0]
+    elif ids.added and ids.added[0] is not None:
+        new = session.query(model).get(ids.added[0])
+    else:
+        new = old
+    return old, new
+
+
+def _contribution(session, obj, before):
+    """
+    What an object adds to the aggregates of its parent: (children, files,
+    bytes), before or after the flush.
+    """
+    if isinstance(obj, File):
+        if before:
+            status = _committed(session, obj, 'status')
+            size = _committed(session, obj, 'st_size')
+        else:
+            status, size = obj.status, obj.st_size
+        # new files without a status are ready by default
+        if (status or 'ready') != 'ready':
+            return 0, 0, 0
+        return 1, 1, size or 0
+    if not sa.inspect(obj).has_identity:
+        return 1, 0, 0
+    # the stored values, they are changed by statements only
+    model = type(obj)
+    files, size = session.query(model.file_count, model.byte_count) \
+        .filter(model.id == obj.id).one()
+    return 1, files, size
+
+
+def _changes(obj):
+    """ whether the flush changes the place or the size of an object """
+    state = sa.inspect(obj)
+    name = _parent_name(obj)
+    keys = [name, state.mapper.get_property_by_column(
+        list(state.mapper.relationships[name].local_columns)[0]).key]
+    if isinstance(obj, File):
+        keys += ['status', 'st_size']
+    return any(state.attrs[key].history.has_changes() for key in keys)
+
+
+def collect_deltas(session, flush_context, instances):
+    """
+    Session event that works out how a flush changes the aggregates. The
+    differences of an object are added to its (old or new) parent and, the
+    number of files and bytes only, to the ancestors of the parent after
+    the flush. Objects of deleted parents are left out, the stored
+    aggregates of the parent account for them.
+    """
+    deltas = {}
+    parents = {}
+
+    def parents_of(obj):
+        if obj not in parents:
+            name = _parent_name(obj)
+            parents[obj] = _parents(session, obj, name) if name else (None, None)
+        return parents[obj]
+
+    def add(parent, contribution, sign):
+        children = contribution[0]
+        while parent is not None and parent not in session.deleted:
+            delta = deltas.setdefault(parent, [0, 0, 0])
+            delta[0] += sign * children
+            delta[1] += sign * contribution[1]
+            delta[2] += sign * contribution[2]
+            children = 0
+            parent = parents_of(parent)[1]
+
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if _parent_name(obj) is None:
+            continue
+        state = sa.inspect(obj)
+        if state.has_identity and obj not in session.deleted and not _changes(obj):
+            continue
+        old, new = parents_of(obj)
+        if old is not None:
+            add(old, _contribution(session, obj, True), -1)
+        if new is not None:
+            add(new, _contribution(session, obj, False), 1)
+    session.info[_DELTAS] = deltas
+
+sa.event.listen(orm.Session, 'before_flush', collect_deltas)
+
+
+def apply_deltas(session, flush_context):
+    """
+    Session event that applies the differences of collect_deltas() once all
+    objects are written, to new objects as well.
+    """
+    deltas = session.info.pop(_DELTAS, None)
+    updated = []
+    for obj, (children, files, size) in (deltas or {}).items():
+        if obj in session.deleted or not (children or files or size):
+            continue
+        table = orm.object_mapper(obj).columns['child_count'].table
+        session.execute(
+            table.update().where(table.c.id == obj.id).values(
+                child_count=table.c.child_count + children,
+                file_count=table.c.file_count + files,
+                byte_count=table.c.byte_count + size))
+        updated.append(obj)
+    if updated:
+        session.info[_UPDATED] = updated
+        cache.touch(session, updated)
+
+sa.event.listen(orm.Session, 'after_flush', apply_deltas)
+
+
+def expire_updated(session, flush_context):
+    """
+    Session event that expires the aggregates updated by apply_deltas(), so
+    they are loaded again when used.
+    """
+    for obj in session.info.pop(_UPDATED, ()):
+        if sa.inspect(obj).persistent:
+            session.expire(obj, AGGREGATES)
+
+sa.event.listen(orm.Session, 'after_flush_postexec', expire_updated)
+
+
+def recount(session):
+    """
+    Computes all aggregates from scratch, e.g. for a database that was
+    changed by statements that bypass the flush, in one transaction. The
+    session is committed.
+
+    :param session:     an open session.
+    """
+    files = File.__table__
+    ready = files.c.status == 'ready'
+    # from the files up: the child table and the column referring to the
+    # parent, the parent table
+    levels = [(files, files.c.neuro_representation_id, NeuroRepresentation.__table__),
+              (NeuroRepresentation.__table__, NeuroRepresentation.__table__.c.tissue_sample_id,
+               TissueSample.__table__),
+              (TissueSample.__table__, TissueSample.__table__.c.experiment_id,
+               Experiment.__table__),
+              (Experiment.__table__, Experiment.__table__.c.scientist_id,
+               Scientist.__table__)]
+    for child, ref, parent in levels:
+        condition = ref == parent.c.id
+        if child is files:
+            condition &= ready
+            file_count = sa.func.count()
+            byte_count = sa.func.coalesce(sa.func.sum(files.c.st_size), 0)
+        else:
+            file_count = sa.func.coalesce(sa.func.sum(child.c.file_count), 0)
+            byte_count = sa.func.coalesce(sa.func.sum(child.c.byte_count), 0)
+        session.execute(parent.update().values(
+            child_count=sa.select([sa.func.count()]).where(condition).as_scalar(),
+            file_count=sa.select([file_count]).where(condition).as_scalar(),
+            byte_count=sa.select([byte_count]).where(condition).as_scalar()))
+    for model in (NeuroRepresentation, TissueSample, Experiment, Scientist):
+        cache.bump(model, session)
+    session.commit()
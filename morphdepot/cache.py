@@ -0,0 +1,453 @@
+"""
+Process-wide version counters of database tables, used to invalidate data
+derived from the tables. The counters of all tables touched by a flush are
+incremented after the flush.
+
+The content of the dimension tables is cached here as well, for listings,
+rendering and the validation of foreign keys without a query, and the
+listings of directories as compact descriptors of the listed objects.
+
+Every flush records what it changed in the change feed (the changes table)
+as well, so other processes can invalidate their caches (see changes).
+
+"""
+from __future__ import division, unicode_literals, print_function
+
+import uuid
+import threading
+from collections import namedtuple, OrderedDict
+
+import yaml
+import sqlalchemy as sa
+import sqlalchemy.orm as orm
+
+import morphdepot.config as config
+from morphdepot.models import Base
+from morphdepot.serializer import SafeDumper
+from morphdepot.models.dimensions import all_dimensions
+
+_versions = {}
+# incremented by reset(), part of every version
+_epoch = [0]
+_lock = threading.Lock()
+
+# counters and observed values reported by stats()
+_counters = {}
+_observed = {}
+
+
+def count(name, n=1):
+    """
+    Increments a counter, see stats().
+    """
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+def observe(name, value):
+    """
+    Records a value, e.g. a size, of which the last and the maximum are
+    reported by stats().
+    """
+    with _lock:
+        last, maximum = _observed.get(name, (0, 0))
+        _observed[name] = (value, max(value, maximum))
+
+
+def stats():
+    """
+    Metrics of the caches and the sessions of this process.
+
+    :return:        a dict.
+    """
+    with _lock:
+        result = dict(_counters)
+        for name, (last, maximum) in _observed.items():
+            result[name] = {'last': last, 'max': maximum}
+        result['listings'] = len(_listings)
+        result['cursors'] = len(_cursors)
+        result['dimensions'] = len(_dimensions)
+        result['tables'] = len(_versions)
+    return result
+
+
+def table_version(tables):
+    """
+    The current version of one or more tables.
+
+    :param tables:  table names or Table objects.
+
+    :return:        a tuple with the epoch and one counter per table.
+    """
+    return (_epoch[0],) + tuple(_versions.get(getattr(t, 'name', t), 0) for t in tables)
+
+
+def _bump(names):
+    with _lock:
+        for name in names:
+            _versions[name] = _versions.get(name, 0) + 1
+
+
+def bump(model, session=None):
+    """
+    Marks all objects of a model class and its subclasses as changed, e.g.
+    after a bulk update that does not trigger the flush events.
+
+    :param model:   a model class.
+    :param session: if given, the change is recorded in the change feed
+                    within the transaction of the session, which has to
+                    be committed afterwards.
+    """
+    tables = set()
+    objects = set()
+    for mapper in sa.inspect(model).self_and_descendants:
+        tables.update(t.name for t in mapper.tables)
+        objects.add((mapper.class_, None, None))
+    _bump(tables)
+    _invalidate(objects)
+    if session is not None:
+        record(session, tables, objects)
+
+
+def reset():
+    """
+    Invalidates all cached data, e.g. if changes may have been missed.
+    """
+    with _lock:
+        _epoch[0] += 1
+    invalidate_listings(models=list(_parents))
+
+
+def model_version(model):
+    """
+    The current version of the objects of a model class, including those of
+    its subclasses. This is the version of the table of the class itself,
+    as a flush bumps all tables of the changed objects including those of
+    their base classes (see bump_flushed).
+    """
+    return table_version([sa.inspect(model).local_table])
+
+
+# names of the attributes that refer to other objects (not to dimensions)
+# by mapper
+_references = {}
+
+
+def references(mapper):
+    """
+    The attributes of a mapped class that refer to other objects, by which
+    they may be listed (see listing()).
+
+    :return:        a tuple of attribute names.
+    """
+    names = _references.get(mapper)
+    if names is None:
+        names = _references[mapper] = tuple(
+            prop.key for prop in mapper.column_attrs
+            if any(c.foreign_keys and not c.primary_key and dimension_of(c) is None
+                   for c in prop.columns))
+    return names
+
+
+def _changed(instances):
+    """
+    The tables and the (class, attribute, value) tuples of changed objects,
+    see bump_flushed().
+    """
+    tables = set()
+    # (class, None, None) for every changed object, (class, attribute, id)
+    # for every object it refers (or referred) to
+    objects = set()
+    for obj in instances:
+        mapper = orm.object_mapper(obj)
+        tables.update(t.name for t in mapper.tables)
+        objects.add((mapper.class_, None, None))
+        state = sa.inspect(obj)
+        for name in references(mapper):
+            # the old and the new value, the history is still available
+            # after the flush
+            added, unchanged, deleted = state.attrs[name].history
+            for value in set(added or ()) | set(unchanged or ()) | set(deleted or ()):
+                if value is not None:
+                    objects.add((mapper.class_, name, value))
+    return tables, objects
+
+
+def bump_flushed(session, flush_context):
+    """
+    Session event that bumps the tables of all objects changed by a flush,
+    including the tables of their base classes, drops the listings of the
+    directories the objects are (or were) listed in, and records the
+    changes in the change feed.
+    """
+    tables, objects = _changed(list(session.new) + list(session.dirty) + list(session.deleted))
+    _bump(tables)
+    _invalidate(objects)
+    record(session, tables, objects)
+
+sa.event.listen(orm.Session, 'after_flush', bump_flushed)
+
+
+def touch(session, instances):
+    """
+    Marks objects as changed that were updated by a statement during a
+    flush rather than by the flush itself, like bump_flushed() does for the
+    objects of the flush.
+
+    :param session:     the flushing session.
+    :param instances:   the updated objects.
+    """
+    tables, objects = _changed(instances)
+    _bump(tables)
+    _invalidate(objects)
+    record(session, tables, objects)
+
+
+def _invalidate(objects):
+    """
+    Drops the listings of changed objects.
+
+    :param objects: (class, attribute, value) tuples as in bump_flushed().
+    """
+    refs = {}
+    for cls, name, value in objects:
+        values = refs.setdefault(cls, {})
+        if name is not None:
+            values.setdefault(name, set()).add(value)
+    keys = set()
+    models = set()
+    for model, parent in list(_parents.items()):
+        for cls, values in refs.items():
+            if not issubclass(cls, model):
+                continue
+            if parent is None:
+                keys.add((model, None))
+            elif values.get(parent):
+                keys.update((model, value) for value in values[parent])
+            else:
+                # not known where the objects are listed
+                models.add(model)
+    invalidate_listings(keys, models)
+
+
+# notification channel of the change feed (PostgreSQL only)
+CHANNEL = 'morphdepot_changes'
+
+
+def record(session, tables=(), objects=()):
+    """
+    Records changes in the change feed, within the transaction of a session.
+    Other processes see them when the transaction is committed.
+
+    :param session: an open session.
+    :param tables:  names of changed tables.
+    :param objects: (class, attribute, value) tuples of changed objects as
+                    in bump_flushed().
+    """
+    rows = [{'kind': 'table', 'name': name, 'attribute': None, 'key': None}
+            for name in tables]
+    rows += [{'kind': 'object', 'name': cls.__name__, 'attribute': name,
+              'key': None if value is None else str(value)}
+             for cls, name, value in objects]
+    if not rows:
+        return
+    session.execute(Base.metadata.tables['changes'].insert(), rows)
+    if session.get_bind().dialect.name == 'postgresql':
+        # delivered on commit
+        session.execute("NOTIFY %s" % CHANNEL)
+
+
+def apply(changes):
+    """
+    Invalidates the data affected by changes read from the change feed.
+
+    :param changes: (kind, name, attribute, key) tuples as recorded by
+                    record().
+    """
+    classes = {}
+    for model in list(_parents):
+        for mapper in sa.inspect(model).self_and_descendants:
+            classes[mapper.class_.__name__] = mapper.class_
+    tables = set()
+    objects = set()
+    for kind, name, attribute, key in changes:
+        if kind == 'table':
+            tables.add(name)
+        elif name in classes:
+            try:
+                value = None if key is None else uuid.UUID(key)
+            except ValueError:
+                value = key
+            objects.add((classes[name], attribute, value))
+    _bump(tables)
+    _invalidate(objects)
+
+
+# the content of a dimension table: a dict name -> (description, comment),
+# the set of names and the rendering as YAML
+Dimension = namedtuple('Dimension', ['entries', 'names', 'yaml'])
+
+# content of dimension tables by table name, with the versions they reflect
+_dimensions = {}
+
+
+def dimension(session, model):
+    """
+    The content of a dimension table. It is cached until the table changes.
+
+    :param session: an open session.
+    :param model:   a dimension class (see models.dimensions).
+
+    :return:        a Dimension.
+    """
+    table = model.__table__
+    version = table_version([table])
+    cached = _dimensions.get(table.name)
+    if cached is None or cached[0] != version:
+        entries = dict((name, (description, comment)) for name, description, comment
+                       in session.query(table.c.name, table.c.description, table.c.comment))
+        rendered = dict((name, {"description": description, "comment": comment})
+                        for name, (description, comment) in entries.items())
+        data = yaml.dump(rendered, Dumper=SafeDumper, default_flow_style=False)
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        cached = _dimensions[table.name] = \
+            (version, Dimension(entries, frozenset(entries), data))
+    return cached[1]
+
+
+def dimension_names(session, model):
+    """
+    The names of all entries of a dimension table (see dimension()).
+
+    :return:        a frozenset of names.
+    """
+    return dimension(session, model).names
+
+
+def dimension_of(column):
+    """
+    The dimension a column refers to.
+
+    :param column:  a Column.
+
+    :return:        a dimension class or None.
+    """
+    for fk in column.foreign_keys:
+        for model in all_dimensions:
+            if fk.column.table is model.__table__:
+                return model
+    return None
+
+
+#-------------------------------------------------------------------------------
+# DIRECTORY LISTINGS
+#-------------------------------------------------------------------------------
+
+# descriptor of an object listed in a directory, mtime, ctime, size and
+# nlink are those reported by stat
+Child = namedtuple('Child', ['name', 'id', 'model', 'mtime', 'ctime', 'size', 'nlink'])
+
+# listings by (listed model, id of the parent object), least recently used
+# first, at most CACHE['listings']
+_listings = OrderedDict()
+# the attribute of a listed model that refers to the parent object
+_parents = {}
+# incremented by every invalidation, listings loaded meanwhile are not kept
+_generation = [0]
+# keyset cursors of paged listings (see cursor())
+_cursors = OrderedDict()
+
+
+def listing(model, parent, parent_id, load):
+    """
+    The objects of a model listed in a directory. Listings are cached until
+    a flush changes one of the listed objects, or adds or moves an object
+    to the directory, or until they are the least recently used of more
+    than CACHE['listings'] listings.
+
+    :param model:       the listed model class.
+    :param parent:      the name of the attribute of the model that refers
+                        to the object of the directory, None if all objects
+                        of the model are listed.
+    :param parent_id:   the id of the object of the directory or None.
+    :param load:        a function that returns a list of Child tuples.
+
+    :return:            a list of Child tuples.
+    """
+    key = (model, parent_id)
+    with _lock:
+        children = _listings.pop(key, None)
+        if children is not None:
+            _listings[key] = children
+            _counters['listing_hits'] = _counters.get('listing_hits', 0) + 1
+            return children
+
+    count('listing_misses')
+    _parents[model] = parent
+    generation = _generation[0]
+    children = load()
+    with _lock:
+        if generation == _generation[0]:
+            _listings[key] = children
+            while len(_listings) > config.CACHE['listings']:
+                _listings.popitem(last=False)
+    return children
+
+
+def cached_listing(model, parent_id):
+    """
+    A listing if it is cached (see listing()), without loading it.
+
+    :return:            a list of Child tuples or None.
+    """
+    key = (model, parent_id)
+    with _lock:
+        children = _listings.pop(key, None)
+        if children is not None:
+            _listings[key] = children
+            _counters['listing_hits'] = _counters.get('listing_hits', 0) + 1
+    return children
+
+
+def cursor(model, parent_id, page, id=None):
+    """
+    The keyset cursor of a page of a listing that is read page by page: the
+    id of the last object of the preceding page. Cursors stay usable when
+    the listing changes, they are dropped only if they are the least
+    recently used of more than CACHE['cursors'].
+
+    :param model:       the listed model class.
+    :param parent_id:   the id of the object of the directory or None.
+    :param page:        the number of the page.
+    :param id:          if given, the cursor is set.
+
+    :return:            the id or None if the cursor is unknown.
+    """
+    key = (model, parent_id, page)
+    with _lock:
+        if id is None:
+            id = _cursors.pop(key, None)
+        if id is not None:
+            _cursors[key] = id
+            while len(_cursors) > config.CACHE['cursors']:
+                _cursors.popitem(last=False)
+    return id
+
+
+def invalidate_listings(keys=(), models=()):
+    """
+    Drops cached listings.
+
+    :param keys:    (model, parent id) tuples of single listings.
+    :param models:  model classes of which all listings are dropped.
+    """
+    models = tuple(models)
+    with _lock:
+        _generation[0] += 1
+        for key in keys:
+            _listings.pop(key, None)
+        if models:
+            for key in list(_listings):
+                if issubclass(key[0], models):
+                    del _listings[key]
@@ -0,0 +1,163 @@
+"""
+Reads the change feed, the changes table written by the flushes of all
+processes (see cache.record), to invalidate the data cached by this
+process. Sequence numbers of the feed are assigned when a change is
+recorded, but seen by others only when the transaction is committed, so
+missing numbers are polled for a while (CHANGES['gap_timeout']).
+
+"""
+from __future__ import division, unicode_literals, print_function
+
+import time
+import select
+import logging
+import datetime as dt
+import threading
+
+import sqlalchemy as sa
+
+import morphdepot.config as config
+from morphdepot import cache
+from morphdepot.models.core import Change
+
+# missing sequence numbers that are polled for at most, if more are
+# missing all cached data is dropped instead
+MAX_GAPS = 500
+
+
+class Poller(threading.Thread):
+    """
+    Background thread that polls the change feed every
+    CHANGES['poll_interval'] seconds, or as soon as a change is notified
+    (PostgreSQL only), and prunes changes older than CHANGES['retention'].
+    """
+
+    def __init__(self, engine, interval=None):
+        """
+        :param engine:      the engine of the database.
+        :param interval:    seconds between two polls
+                            (default CHANGES['poll_interval']).
+        """
+        super(Poller, self).__init__(name="change poller")
+        self.daemon = True
+        self.engine = engine
+        self.interval = interval or config.CHANGES['poll_interval']
+        # the highest sequence number read and the missing ones below it,
+        # with the time they were missed first
+        self.last = None
+        self.gaps = {}
+        # time of the last poll and of the last pruning
+        self.polled = None
+        self.pruned = 0
+        self.listener = None
+
+    def start(self):
+        # only later changes concern the (empty) caches of this process
+        self.poll()
+        super(Poller, self).start()
+
+    def poll(self):
+        """
+        Reads the changes committed since the last poll and invalidates the
+        affected data.
+
+        :return:        the number of changes read.
+        """
+        table = Change.__table__
+        now = time.time()
+        with self.engine.connect() as connection:
+            if self.last is None:
+                self.last = connection.execute(
+                    sa.select([sa.func.max(table.c.seq)])).scalar() or 0
+                self.polled = now
+                return 0
+            condition = table.c.seq > self.last
+            if self.gaps:
+                condition = sa.or_(condition, table.c.seq.in_(sorted(self.gaps)))
+            rows = connection.execute(
+                sa.select([table.c.seq, table.c.kind, table.c.name,
+                           table.c.attribute, table.c.key])
+                .where(condition).order_by(table.c.seq)).fetchall()
+
+        reset = now - self.polled > config.CHANGES['retention']
+        self.polled = now
+        for row in rows:
+            seq = row[0]
+            self.gaps.pop(seq, None)
+            if seq > self.last:
+                if seq - self.last - 1 + len(self.gaps) > MAX_GAPS:
+                    reset = True
+                else:
+                    self.gaps.update((missing, now) for missing in range(self.last + 1, seq))
+                self.last = seq
+        timeout = config.CHANGES['gap_timeout']
+        self.gaps = dict((seq, t) for seq, t in self.gaps.items()
+                         if now - t < timeout and not reset)
+
+        if reset:
+            # changes may have been pruned before they were read
+            cache.reset()
+            cache.count('change_resets')
+        else:
+            cache.apply([tuple(row[1:]) for row in rows])
+        cache.count('changes', len(rows))
+        return len(rows)
+
+    def prune(self):
+        """
+        Deletes changes older than CHANGES['retention'], at most once per
+        tenth of it.
+        """
+        retention = config.CHANGES['retention']
+        if time.time() - self.pruned < retention / 10:
+            return
+        table = Change.__table__
+        before = dt.datetime.now() - dt.timedelta(seconds=retention)
+        with self.engine.begin() as connection:
+            connection.execute(table.delete().where(table.c.ctime < before))
+        self.pruned = time.time()
+
+    def listen(self):
+        """
+        A connection that receives the notifications of committed changes,
+        None if notifications are not available.
+        """
+        if self.engine.dialect.name != 'postgresql' or not config.CHANGES['listen']:
+            return None
+        connection = self.engine.raw_connection()
+        # not returned to the pool
+        connection.detach()
+        connection = connection.connection
+        connection.autocommit = True
+        cursor = connection.cursor()
+        cursor.execute("LISTEN %s" % cache.CHANNEL)
+        cursor.close()
+        return connection
+
+    def wait(self):
+        """
+        Waits for the next poll.
+        """
+        if self.listener is None:
+            time.sleep(self.interval)
+            return
+        try:
+            if select.select([self.listener], [], [], self.interval)[0]:
+                self.listener.poll()
+                del self.listener.notifies[:]
+        except Exception:
+            logging.exception("Waiting for change notifications failed")
+            self.listener = None
+
+    def run(self):
+        try:
+            self.listener = self.listen()
+        except Exception:
+            logging.exception("Listening for changes failed")
+        while True:
+            try:
+                self.poll()
+                self.prune()
+            except Exception:
+                logging.exception("Polling changes failed")
+            self.wait()
@@ -4,19 +4,100 @@ DB = {
     'echo': True,
     'schema': 'public',
     'add_test_data': True,
-    'pg_recreate_schema': False
+    'pg_recreate_schema': False,
+    # how ids are stored on other databases than PostgreSQL: 'hex' (32
+    # characters) or 'binary' (16 bytes). Use 'morph_admin.py uuids' to
+    # convert an existing SQLite database after changing it.
+    'uuid_storage': 'hex'
 }
 
 #DB = {
-#    'url': 'sqlite://',
+#    'url': 'sqlite:////var/lib/morphdepot/morphdepot.db',
 #    'type': 'sqlite',
 #    'echo': False,
 #    'schema': 'ginjang_ndb',
 #    'add_test_data': True,
+#    'pg_recreate_schema': False,
+#    'uuid_storage': 'binary'
 #}
 
+# settings of every connection to a SQLite database file (see db)
+SQLITE = {
+    # write-ahead logging, readers do not block the writer and vice versa
+    'journal_mode': 'wal',
+    # 'normal' is safe with WAL, a power loss may only lose the last commits
+    'synchronous': 'normal',
+    # page cache per connection, negative values are KiB
+    'cache_size': -64 * 1024,
+    # bytes of the database file read through a memory mapping
+    'mmap_size': 256 * 1024 * 1024,
+    # seconds to wait for a lock or a free connection
+    'timeout': 30,
+    # read-only connections kept open per process, in addition to the one
+    # writer
+    'readers': 4
+}
+
 RAW_DATA = {
     'root_dir': '/tmp/MorphDepot/raw_data',
-    'tmp_dir': '/tmp'
+    'tmp_dir': '/tmp',
+    # widths of the id prefixes used as intermediate directories, e.g. (2, 2)
+    # stores a representation in ab/cd/<uuid>. Use 'morph_admin.py relayout'
+    # to move existing data after changing it.
+    'fanout': (),
+    # how add_file puts files into root_dir: 'copy', 'reflink', 'hardlink'
+    # or 'move'. Unsupported modes fall back to a copy.
+    'ingest_mode': 'copy',
+    # store files with the same content only once, as hard links into a
+    # content-addressed store below root_dir/.objects
+    'dedup': False,
+    # bytes read at once when computing file checksums
+    'chunk_size': 1024 * 1024,
+    # concurrent removals and seconds between two runs of the collector of
+    # deleted files and directories
+    'collect_threads': 4,
+    'collect_interval': 60
 }
 
+SCRUB = {
+    # worker processes, None means one per CPU
+    'processes': None,
+    # maximum total read rate in MB/s, 0 means unlimited
+    'rate': 0
+}
+
+INGEST = {
+    # worker processes of 'morph_admin.py ingest'
+    'workers': 4,
+    # seconds a worker waits when the queue is empty
+    'poll_interval': 1.0,
+    # seconds after which a claimed job is considered abandoned
+    'stale_after': 3600,
+    # jobs that failed this often are not retried
+    'max_attempts': 3
+}
+
+CACHE = {
+    # directory listings kept in memory, the least recently used listings
+    # are dropped first
+    'listings': 10000,
+    # objects read at once when a directory that is not cached is read
+    # page by page, smaller directories are cached as a whole
+    'page': 500,
+    # keyset cursors of pages of large directories kept in memory
+    'cursors': 10000
+}
+
+CHANGES = {
+    # seconds between two polls of the change feed by a mount
+    'poll_interval': 1.0,
+    # wait for notifications between polls (PostgreSQL only), so changes
+    # are seen immediately
+    'listen': True,
+    # seconds a missing sequence number is polled for, it may belong to a
+    # transaction that is not committed yet
+    'gap_timeout': 60,
+    # seconds changes are kept in the feed. A process that could not poll
+    # for longer drops all cached data.
+    'retention': 3600
+}
@@ -0,0 +1,280 @@
+"""
+Database connection helpers shared by the file system and the command line
+tools.
+
+A SQLite database file is used with the settings of config.SQLITE: every
+connection is configured when it is opened, and sessions read through a
+pool of read-only connections while all writes of the process go through
+a single connection (see RoutingSession).
+
+"""
+from __future__ import division, unicode_literals, print_function
+
+import binascii
+
+import sqlalchemy
+import sqlalchemy.orm as orm
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.expression import Select
+
+import morphdepot.config as config
+import morphdepot.models.morph
+import morphdepot.models.ephys
+from morphdepot.models import Base
+from morphdepot.models.utils.beanbags import UUID
+
+# rows converted at once by migrate_uuids()
+MIGRATE_BATCH = 1000
+
+
+def is_sqlite_file(url):
+    """
+    Whether a database URL refers to a SQLite database file, as opposed to
+    another database or an in-memory SQLite database.
+    """
+    url = sqlalchemy.engine.url.make_url(url)
+    return url.get_backend_name() == 'sqlite' and url.database not in (None, '', ':memory:')
+
+
+def sqlite_pragmas(readonly=False):
+    """
+    The PRAGMA statements that configure a SQLite connection.
+
+    :param readonly:    whether the connection is only used for reading.
+
+    :return:            a list of statements.
+    """
+    pragmas = ["PRAGMA foreign_keys=ON",
+               "PRAGMA journal_mode=%s" % config.SQLITE['journal_mode'],
+               "PRAGMA synchronous=%s" % config.SQLITE['synchronous'],
+               "PRAGMA cache_size=%i" % config.SQLITE['cache_size'],
+               "PRAGMA mmap_size=%i" % config.SQLITE['mmap_size']]
+    if readonly:
+        pragmas.append("PRAGMA query_only=ON")
+    return pragmas
+
+
+def create_engine(readonly=False, recreate_schema=False):
+    """
+    Creates an engine for the database configured in config.DB and makes
+    sure all tables exist.
+
+    Engines of a SQLite database file are configured by config.SQLITE. The
+    engine of the writer has one connection, so the writes of the process
+    do not compete for the lock of the database, a read-only engine keeps
+    SQLITE['readers'] connections open.
+
+    :param readonly:        create a read-only engine (SQLite only).
+    :param recreate_schema: drop and recreate the schema first (PostgreSQL
+                            only).
+
+    :return:        a new SQLAlchemy engine.
+    """
+    url = config.DB['url']
+    kwargs = {'echo': config.DB['echo']}
+    sqlite_file = is_sqlite_file(url)
+    if sqlite_file:
+        # connections are shared by the threads of the file system
+        kwargs['connect_args'] = {'check_same_thread': False,
+                                  'timeout': config.SQLITE['timeout']}
+        kwargs['poolclass'] = QueuePool
+        if readonly:
+            # sessions of open files keep their connection, more than
+            # pool_size are closed when they are returned
+            kwargs['pool_size'] = config.SQLITE['readers']
+            kwargs['max_overflow'] = -1
+        else:
+            kwargs['pool_size'] = 1
+            kwargs['max_overflow'] = 0
+        kwargs['pool_timeout'] = config.SQLITE['timeout']
+    engine = sqlalchemy.create_engine(url, **kwargs)
+
+    if config.DB['type'] == "sqlite":
+        pragmas = sqlite_pragmas(readonly) if sqlite_file else ["PRAGMA foreign_keys=ON"]
+
+        @sqlalchemy.event.listens_for(engine, 'connect')
+        def configure(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for pragma in pragmas:
+                cursor.execute(pragma)
+            cursor.close()
+
+    elif config.DB['type'] == "postgresql" and recreate_schema:
+        engine.execute("DROP SCHEMA %s CASCADE;" % (config.DB['schema']))
+        engine.execute("CREATE SCHEMA %s;" % (config.DB['schema']))
+
+    if not readonly:
+        Base.metadata.create_all(engine)
+    return engine
+
+
+class RoutingSession(orm.Session):
+    """
+    A session that executes SELECT statements on the read engine given as
+    info['read_engine'] until the session writes for the first time, then
+    everything on its bind until the end of the transaction, so it reads
+    its own changes.
+    """
+
+    writing = False
+
+    def get_bind(self, mapper=None, clause=None):
+        if not self.writing:
+            if not self._flushing and isinstance(clause, Select):
+                return self.info['read_engine']
+            self.writing = True
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+
+@sqlalchemy.event.listens_for(RoutingSession, 'after_transaction_end')
+def end_writing(session, transaction):
+    if transaction.parent is None:
+        session.writing = False
+
+
+def sessionmaker(engine=None):
+    """
+    A sessionmaker for the given (or a newly created) engine. Sessions of a
+    SQLite database file read through a pool of read-only connections (see
+    RoutingSession).
+
+    :param engine:  an engine created by create_engine() or None.
+
+    :return:        a sessionmaker.
+    """
+    if engine is None:
+        engine = create_engine()
+    if is_sqlite_file(engine.url):
+        return orm.sessionmaker(bind=engine, class_=RoutingSession,
+                                info={'read_engine': create_engine(readonly=True)})
+    return orm.sessionmaker(bind=engine)
+
+
+def create_session(engine=None):
+    """
+    Opens a new session on the given (or a newly created) engine.
+
+    :param engine:  an engine created by create_engine() or None.
+
+    :return:        a new Session.
+    """
+    return sessionmaker(engine)()
+
+
+def upgrade_schema(engine):
+    """
+    Adds the columns that were added to the models after the schema of an
+    existing database was created, and the missing tables. Existing rows
+    get the default of a column, values derived from other data have to be
+    filled in afterwards (see 'morph_admin.py upgrade').
+
+    :param engine:  an engine of the database.
+
+    :return:        the added columns as 'table.column' names.
+    """
+    dialect = engine.dialect
+    preparer = dialect.identifier_preparer
+    added = []
+    with engine.begin() as connection:
+        inspector = sqlalchemy.inspect(connection)
+        existing = set(inspector.get_table_names())
+        for table in Base.metadata.sorted_tables:
+            if table.name not in existing:
+                continue
+            present = set(c['name'] for c in inspector.get_columns(table.name))
+            for column in table.columns:
+                if column.name in present:
+                    continue
+                ddl = "ALTER TABLE %s ADD COLUMN %s %s" % (
+                    preparer.format_table(table), preparer.format_column(column),
+                    column.type.compile(dialect=dialect))
+                default = column.default
+                if default is not None and default.is_scalar:
+                    ddl += " DEFAULT %s" % sqlalchemy.literal(default.arg, column.type).compile(
+                        dialect=dialect, compile_kwargs={'literal_binds': True})
+                elif not column.nullable:
+                    raise ValueError("%s.%s is required but has no default"
+                                     % (table.name, column.name))
+                if not column.nullable:
+                    ddl += " NOT NULL"
+                connection.execute(ddl)
+                added.append("%s.%s" % (table.name, column.name))
+    Base.metadata.create_all(engine)
+    return added
+
+
+def migrate_uuids(engine, storage):
+    """
+    Converts the stored ids of all UUID columns of a SQLite database to
+    hex or binary storage (see UUID), in one transaction. Values that are
+    stored in the requested way already are kept, so an interrupted
+    migration can be repeated. The declared column types are not changed,
+    SQLite stores the values as they are.
+
+    :param engine:  an engine of the database.
+    :param storage: 'hex' or 'binary', config.DB['uuid_storage'] has to be
+                    set accordingly afterwards.
+
+    :return:        the number of converted values.
+    """
+    if engine.dialect.name != 'sqlite':
+        raise ValueError("ids are converted on SQLite databases only")
+    if storage not in ('hex', 'binary'):
+        raise ValueError("unknown storage '%s'" % storage)
+    binary = engine.dialect.dbapi.Binary
+
+    def convert(value):
+        if value is None:
+            return None
+        if storage == 'binary':
+            if isinstance(value, type(u'')):
+                return binary(binascii.unhexlify(value))
+        elif not isinstance(value, type(u'')):
+            return binascii.hexlify(bytes(value)).decode('ascii')
+        return value
+
+    count = 0
+    raw = engine.raw_connection()
+    dbapi_connection = raw.connection
+    level = dbapi_connection.isolation_level
+    # the driver would commit before every PRAGMA statement, transactions
+    # are controlled here instead
+    dbapi_connection.isolation_level = None
+    cursor = raw.cursor()
+    try:
+        cursor.execute("BEGIN")
+        # ids and the foreign keys that refer to them are converted by
+        # separate statements, they are checked on commit
+        cursor.execute("PRAGMA defer_foreign_keys=ON")
+        for table in Base.metadata.sorted_tables:
+            names = [c.name for c in table.columns if isinstance(c.type, UUID)]
+            if not names:
+                continue
+            select = 'SELECT rowid, %s FROM "%s" WHERE rowid > ? ORDER BY rowid LIMIT %i' % (
+                ", ".join('"%s"' % n for n in names), table.name, MIGRATE_BATCH)
+            update = 'UPDATE "%s" SET %s WHERE rowid = ?' % (
+                table.name, ", ".join('"%s" = ?' % n for n in names))
+            last = 0
+            while True:
+                batch = cursor.execute(select, (last,)).fetchall()
+                if not batch:
+                    break
+                params = []
+                for row in batch:
+                    values = [convert(value) for value in row[1:]]
+                    changed = sum(new is not old for new, old in zip(values, row[1:]))
+                    if changed:
+                        params.append(values + [row[0]])
+                        count += changed
+                if params:
+                    cursor.executemany(update, params)
+                last = batch[-1][0]
+        cursor.execute("COMMIT")
+    except Exception:
+        cursor.execute("ROLLBACK")
+        raise
+    finally:
+        cursor.close()
+        dbapi_connection.isolation_level = level
+        raw.close()
+    return count
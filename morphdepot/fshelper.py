@@ -28,6 +28,9 @@ class FuseFile(fuse.Direntry):
     DEFAULT_MODE = 0644 | stat.S_IFREG  # regular file -rw-r--r--
     DEFAULT_UID = os.getuid()           # the user running the fs
     DEFAULT_GID = os.getegid()          # the group of the user running the fs
+    # Writes to buffered files are collected by a FileHandle and passed
+    # to commit() at once when the file is flushed
+    buffered = False
 
     def __init__(self, path, mode=DEFAULT_MODE, uid=DEFAULT_UID, gid=DEFAULT_GID, typ=0, ino=0, offset=0):
         """
@@ -186,6 +189,18 @@ class FuseFile(fuse.Direntry):
         """
         return -errno.EOPNOTSUPP
 
+    @logged
+    def commit(self, data):
+        """
+        Replace the content of a buffered file (see FileHandle).
+
+        :param data: The complete new content of the file.
+        :type data: str
+
+        :return: 0 on success or and negative error code.
+        """
+        return -errno.EOPNOTSUPP
+
     @logged
     def list(self):
         """
@@ -197,6 +212,23 @@ class FuseFile(fuse.Direntry):
         else:
             return -errno.EOPNOTSUPP
 
+    def list_from(self, offset=0):
+        """
+        Lists the content of a directory like list(), but only from a
+        readdir offset on, so a directory can be read in several calls.
+        The offset of every entry is set to the offset that continues the
+        listing after it.
+
+        :param offset: 0 or the offset of the last entry already read.
+        :type offset: int
+
+        :return: an iterator over File or Direntry objects.
+        """
+        contents = self.list()
+        for i, entry in enumerate(contents[offset:], offset + 1):
+            entry.offset = i
+            yield entry
+
     @logged
     def is_dir(self):
         """
@@ -245,6 +277,90 @@ class FuseFile(fuse.Direntry):
         return "%s(%s)" % (self.__class__.__name__, str(self.path))
 
 
+class FileHandle(object):
+    """
+    An open file. Data written to a buffered file (see FuseFile.buffered)
+    is collected in memory and committed as a whole when the file is
+    flushed, so a file that is written in several chunks is only applied
+    once. Writes to other files are passed through.
+    """
+
+    def __init__(self, file, size=None):
+        """
+        Initializes a handle.
+
+        :param file: The opened file.
+        :type file: FuseFile
+        :param size: The size the file was truncated to before it was opened
+                     or None.
+        :type size: int
+        """
+        self.file = file
+        self.__data = None
+        self.__dirty = False
+        if size is not None and file.buffered:
+            self.truncate(size)
+
+    def __content(self):
+        if self.__data is None:
+            data = self.file.read()
+            self.__data = bytearray(data if isinstance(data, bytes) else b'')
+        return self.__data
+
+    def read(self, size=-1, offset=0):
+        """
+        Read the content of the file, including data written but not yet
+        committed.
+        """
+        if self.__data is None:
+            return self.file.read(size, offset)
+        if size < 0:
+            return bytes(self.__data[offset:])
+        return bytes(self.__data[offset:offset + size])
+
+    def write(self, buf, offset=0):
+        """
+        Write data to the file (buffer).
+
+        :return: The number of bytes written or a negative error code.
+        """
+        if not self.file.buffered:
+            return self.file.write(buf, offset)
+        data = self.__content()
+        if offset > len(data):
+            data.extend(b'\0' * (offset - len(data)))
+        data[offset:offset + len(buf)] = buf
+        self.__dirty = True
+        return len(buf)
+
+    def truncate(self, size):
+        """
+        Shrink or expand the file (buffer) to a given size.
+
+        :return: 0 on success or a negative error code.
+        """
+        if not self.file.buffered:
+            return -errno.EOPNOTSUPP
+        data = self.__content()
+        if size < len(data):
+            del data[size:]
+        else:
+            data.extend(b'\0' * (size - len(data)))
+        self.__dirty = True
+        return 0
+
+    def flush(self):
+        """
+        Commit the written data, if any.
+
+        :return: 0 on success or a negative error code.
+        """
+        if not self.__dirty:
+            return 0
+        self.__dirty = False
+        return self.file.commit(bytes(self.__data))
+
+
 class Path(object):
     """
     A path class, that represents the path as an immutable
@@ -308,7 +424,7 @@ class Stat(fuse.Stat):
     """
 
     def __init__(self, st_mode, st_size, st_nlink=1, st_uid=None, st_gid=None,
-                 dt_atime=None, dt_mtime=None, dt_ctime=None):
+                 dt_atime=None, dt_mtime=None, dt_ctime=None, st_blocks=None):
         """
         Initialize the stat object
 
@@ -320,10 +436,14 @@ class Stat(fuse.Stat):
         :param dt_atime: The access time.
         :param dt_mtime: The modification time.
         :param dt_ctime: The creation time.
+        :param st_blocks: The number of 512 byte blocks used (default is
+                          computed from st_size by FUSE).
         """
         self.st_mode = st_mode
         self.st_size = st_size
         self.st_nlink = st_nlink
+        if st_blocks is not None:
+            self.st_blocks = st_blocks
         self.st_uid = st_uid if st_uid is not None else os.getuid()
         self.st_gid = st_gid if st_gid is not None else os.getgid()
         now = datetime.utcnow()
@@ -3,18 +3,47 @@
 import os
 import errno
 import yaml
+import logging
 import stat
+import calendar
+import threading
+from collections import namedtuple, OrderedDict
 
+from sqlalchemy import orm, bindparam
+from sqlalchemy.ext import baked
 from sqlalchemy.orm.session import Session
 from fuse import Direntry
 from log import logged
 from fshelper import FuseFile, Path, Stat
-from serializer import Serializer
-from models.core import Scientist, Experiment, TissueSample, Protocol, Neuron, File, Animal
+from serializer import Serializer, SafeDumper
+from tarstream import TarStream
+import cache
+import config
+import tables
+from models.core import Scientist, Experiment, TissueSample, Protocol, Neuron, File, Animal, \
+    NeuroRepresentation
 from models.morph import MicroscopeImage, MicroscopeImageStack, Segmentation
 from models.ephys import Electrophysiology
 from models.dimensions import AnimalSpecies, all_dimensions
 
+# static folders of a Tissue Sample for raw / processed data
+STATIC_DIRS = {
+    'images': MicroscopeImage,
+    'image_stacks': MicroscopeImageStack,
+    'segmentations': Segmentation,
+    'electrophysiology': Electrophysiology
+}
+
+# cache of the compiled listing and lookup queries (see children_query)
+bakery = baked.bakery()
+
+# objects listed in a folder: the arguments of list_children() and a
+# function that makes the entry of an object from its cache.Child
+Listed = namedtuple('Listed', ['query', 'model', 'parent', 'parent_id', 'stat', 'entry'])
+
+# readdir offsets of the entries after the listed objects of a folder
+TAIL_OFFSET = 1 << 62
+
 #-------------------------------------------------------------------------------
 # HELPER CLASSES
 #-------------------------------------------------------------------------------
@@ -29,14 +58,41 @@ class ModelFile(FuseFile):
 
         :param path:    an absolute path for a given object.
         :type path:     str or a Path instance.
-        :param obj:     an instance of a certain model.
+        :param obj:     an instance of a certain model, or a cache.Child that
+                        describes it. The instance is then loaded only when
+                        needed, from the session given as keyword argument.
         """
-        self.model_instance = obj
+        session = kwargs.pop('session', None)
+        if isinstance(obj, cache.Child):
+            self.child = obj
+            self.__instance = None
+            self.__session = session
+        else:
+            self.child = None
+            self.__instance = obj
+            self.__session = session or Session.object_session(obj)
 
         # TODO add permissions resolution
 
         super(ModelFile, self).__init__(path, *args, **kwargs)
 
+    @property
+    def model_instance(self):
+        if self.__instance is None:
+            self.__instance = children_query(self.child.model)(self.session).get(self.child.id)
+        return self.__instance
+
+    @property
+    def session(self):
+        return self.__session
+
+    @property
+    def id(self):
+        """The id of the object, without loading it"""
+        if self.child is not None:
+            return self.child.id
+        return self.model_instance.id
+
     def getattr(self):
         kwargs = {}
         kwargs['st_mode'] = int(self.mode)
@@ -48,6 +104,26 @@ class ModelFile(FuseFile):
 
         return Stat( **kwargs )
 
+    def child_getattr(self):
+        """
+        Stat from the cache.Child that describes the object, if any.
+        """
+        if self.child is None:
+            return None
+        return Stat(st_mode=int(self.mode), st_size=self.child.size, st_nlink=self.child.nlink,
+                    st_gid=self.gid, st_uid=self.uid, dt_mtime=self.child.mtime,
+                    dt_ctime=self.child.ctime, st_blocks=self.blocks())
+
+    def blocks(self):
+        """
+        The blocks reported by stat, those of an empty folder for folders,
+        whose size is that of the files below, so that du does not count
+        the files twice. None for files.
+        """
+        if self.is_dir():
+            return self.DIRSIZE // 512
+        return None
+
 
 class ModelDir(ModelFile):
     """
@@ -57,6 +133,199 @@ class ModelDir(ModelFile):
         kwargs['mode'] = stat.S_IFDIR | 0755
         super(ModelDir, self).__init__(path, obj, *args, **kwargs)
 
+    def getattr(self):
+        attr = self.child_getattr()
+        if attr is None:
+            attr = super(ModelDir, self).getattr()
+            attr.st_size, attr.st_nlink = dir_stat(self.model_instance)
+            attr.st_blocks = self.blocks()
+        return attr
+
+    @property
+    def source(self):
+        """The object or its descriptor, for files and folders inside"""
+        return self.child if self.child is not None else self.model_instance
+
+    def info_files(self):
+        """
+        Files with the attributes of the object: info.yaml and the same
+        information as info.json and info.msgpack (if available).
+
+        :return:        a list of ModelInfo files.
+        """
+        return [ModelInfo(self.path + ('info.' + fmt), self.source, fmt, session=self.session)
+                for fmt in Serializer.formats()]
+
+
+def children_query(model, parent=None):
+    """
+    A baked query of the objects of a model ordered by id, which is
+    compiled only once.
+
+    :param model:       the model class.
+    :param parent:      the name of an attribute of the model that refers
+                        to a parent object. The query is then filtered by
+                        the bound parameter 'parent_id'.
+
+    :return:            a BakedQuery
+    """
+    bq = bakery(lambda s: s.query(model).order_by(model.id), model, parent)
+    if parent is not None:
+        bq += lambda q: q.filter(getattr(model, parent) == bindparam('parent_id'))
+    return bq
+
+
+def list_children(session, query, model, parent=None, parent_id=None, stat=None):
+    """
+    Lists the objects of a baked query, using the listing cache (see
+    cache.listing).
+
+    :param session:     an open session.
+    :param query:       a query of the listed model, see children_query().
+    :param model:       the listed model class.
+    :param parent:      the name of the attribute of the listed model that
+                        refers to the object of the directory, if any.
+    :param parent_id:   the id of the object of the directory, if any.
+    :param stat:        a function that returns (mtime, ctime, size) for an
+                        object, default are the times of the object and the
+                        size of a directory.
+
+    :return:            a list of cache.Child tuples.
+    """
+    def load():
+        result = query(session)
+        if parent is not None:
+            result = result.params(parent_id=parent_id)
+        return [_child(obj, stat) for obj in result]
+
+    return cache.listing(model, parent, parent_id, load)
+
+
+def page_children(session, query, model, parent=None, parent_id=None, stat=None,
+                  position=0):
+    """
+    Like list_children(), but lists at most CACHE['page'] objects from a
+    position on. If the listing is not cached the objects are read page by
+    page, each page by id from the last id of the preceding page (see
+    cache.cursor), so every page takes one short query on the primary key
+    index. A first page that is the only one is cached as the listing.
+
+    :param position:    the number of objects to skip.
+
+    :return:            a list of cache.Child tuples and whether more
+                        objects may follow.
+    """
+    size = config.CACHE['page']
+    children = cache.cached_listing(model, parent_id)
+    if children is not None:
+        return children[position:position + size], position + size < len(children)
+
+    page, skip = divmod(position, size)
+    after = cache.cursor(model, parent_id, page) if page else None
+    if after is not None:
+        query = query + (lambda q: q.filter(model.id > bindparam('after')))
+    # one more object than a page tells whether more follow
+    query = query + (lambda q: q.offset(bindparam('start')).limit(bindparam('size')))
+    result = query(session)
+    if parent is not None:
+        result = result.params(parent_id=parent_id)
+    if after is not None:
+        result = result.params(after=after)
+    # without a cursor, e.g. if it was dropped, the page is looked up by offset
+    result = result.params(start=0 if after is not None else page * size, size=size + 1)
+    children = [_child(obj, stat) for obj in result]
+
+    if len(children) <= size:
+        if page == 0:
+            cache.listing(model, parent, parent_id, lambda: children)
+        return children[skip:], False
+    children = children[:size]
+    cache.cursor(model, parent_id, page + 1, children[-1].id)
+    return children[skip:], True
+
+
+def _child(obj, stat=None):
+    """ the cache.Child of a listed object, see list_children() """
+    if stat is None:
+        mtime, ctime = obj.mtime, obj.ctime
+        size, nlink = dir_stat(obj)
+    else:
+        mtime, ctime, size = stat(obj)
+        nlink = 1
+    return cache.Child(str(obj), obj.id, obj.__class__, mtime, ctime, size, nlink)
+
+
+def dir_stat(obj):
+    """
+    The size and the number of links reported by stat for the folder of an
+    object, from its aggregates: the total size of the files below and, as
+    usual for folders, 2 plus the number of sub folders.
+
+    :param obj:     a Scientist, Experiment, TissueSample or
+                    NeuroRepresentation.
+
+    :return:        a tuple (st_size, st_nlink).
+    """
+    if isinstance(obj, TissueSample):
+        # 'neurons' and the static folders
+        folders = 1 + len(STATIC_DIRS)
+    elif isinstance(obj, NeuroRepresentation):
+        folders = 0
+    else:
+        folders = obj.child_count or 0
+    return obj.byte_count or 0, 2 + folders
+
+
+class PagedDir(object):
+    """
+    mixin for folders that list the objects of a model (see contents()),
+    which are read page by page by readdir (see list_from()).
+    """
+    def contents(self):
+        """
+        The content of the folder.
+
+        :return:        a list of entries before the listed objects, a
+                        Listed and a list of entries after them.
+        """
+        raise NotImplementedError
+
+    @logged
+    def list(self):
+        head, listed, tail = self.contents()
+        children = list_children(self.session, listed.query, listed.model, listed.parent,
+                                 listed.parent_id, listed.stat)
+        return head + [listed.entry(child) for child in children] + tail
+
+    def list_from(self, offset=0):
+        """
+        Like FuseFile.list_from(), but reads only the pages of listed objects
+        from the offset on (see page_children). The offset of a listed
+        object is its position after the entries before it, entries after
+        the listed objects have offsets from TAIL_OFFSET on.
+        """
+        head, listed, tail = self.contents()
+        for i, entry in enumerate(head[offset:], offset + 1):
+            entry.offset = i
+            yield entry
+
+        if offset < TAIL_OFFSET:
+            position = max(offset - len(head), 0)
+            more = True
+            while more:
+                children, more = page_children(self.session, listed.query, listed.model,
+                                               listed.parent, listed.parent_id, listed.stat,
+                                               position)
+                for child in children:
+                    position += 1
+                    entry = listed.entry(child)
+                    entry.offset = len(head) + position
+                    yield entry
+            offset = TAIL_OFFSET
+
+        for i, entry in enumerate(tail[offset - TAIL_OFFSET:], offset - TAIL_OFFSET + 1):
+            entry.offset = TAIL_OFFSET + i
+            yield entry
 
 #-------------------------------------------------------------------------------
 # STATIC FOLDERS
@@ -75,10 +344,25 @@ class RootDir(FuseFile):
     @logged
     def list(self):
         return [Direntry("."), Direntry(".."), Scientists(self.session),
-                OptionsDir(self.session)]
+                OptionsDir(self.session), TablesDir(self.session), StatsFile()]
 
 
-class Scientists(FuseFile):
+class StatsFile(FuseFile):
+    """
+    It's a static file in the root dir with metrics of the caches and
+    sessions of the file system as YAML (see cache.stats).
+    """
+    def __init__(self):
+        super(StatsFile, self).__init__(path="/.stats", mode=stat.S_IFREG | 0444)
+
+    def read(self, size=-1, offset=0):
+        data = yaml.dump(cache.stats(), Dumper=SafeDumper, default_flow_style=False)
+        if size < 0:
+            return data[offset:]
+        return data[offset:offset + size]
+
+
+class Scientists(PagedDir, FuseFile):
     """
     It's a static folder in the root dir that contains all scientists.
     """
@@ -87,18 +371,14 @@ class Scientists(FuseFile):
         mode = stat.S_IFDIR | 0755
         super(Scientists, self).__init__(path="/scientists", mode=mode)
 
-    @logged
-    def list(self):
+    def contents(self):
         """
         Scientists folder contains all registered scientists.
-
-        :return:        a list of scientist folders.
         """
-        contents = [Direntry("."), Direntry("..")]
-        for sct in self.session.query(Scientist):
-            contents.append(ScientistDir(self.path + str(sct), sct))
-
-        return contents
+        listed = Listed(children_query(Scientist), Scientist, None, None, None,
+                        lambda child: ScientistDir(self.path + child.name, child,
+                                                   session=self.session))
+        return [Direntry("."), Direntry("..")], listed, []
 
 
 class OptionsDir(FuseFile):
@@ -135,66 +415,86 @@ class OptionsDir(FuseFile):
 
         return contents
 
+
+class TablesDir(FuseFile):
+    """
+    It's a static folder in the root dir with one table per model for
+    analytics, e.g. tissue_sample.csv (and tissue_sample.parquet if pyarrow
+    is installed). The CSV tables are writable for bulk updates, if a
+    written table is rejected the errors are listed in e.g.
+    tissue_sample.errors.
+    """
+    def __init__(self, session):
+        self.session = session
+        mode = stat.S_IFDIR | 0755
+        super(TablesDir, self).__init__(path="/tables", mode=mode)
+
+    @logged
+    def list(self):
+        """
+        Tables folder contains a file per model and table format.
+
+        :return:        a list of table files.
+        """
+        contents = [Direntry("."), Direntry("..")]
+        for model in tables.TABLE_MODELS:
+            name = tables.table_name(model)
+            for fmt in tables.formats():
+                contents.append(TableFile(self.path + (name + '.' + fmt), self.session, model, fmt))
+            if tables.errors(model) is not None:
+                contents.append(TableErrors(self.path + (name + '.errors'), model))
+
+        return contents
+
 #-------------------------------------------------------------------------------
 # MODEL FOLDERS
 #-------------------------------------------------------------------------------
 
-class ScientistDir(ModelDir):
+class ScientistDir(PagedDir, ModelDir):
     """
     Class represents a Scientist folder.
     """
-    @logged
-    def list(self):
+    def contents(self):
         """
         Scientist folder contains:
-        - information about the scientist as info.yaml
+        - information about the scientist as info.{yaml,json,msgpack}
         - folders with all experiments, made by this scientist
-
-        :return:        a list of files and folders.
         """
-        contents = [Direntry("."), Direntry("..")]
-
-        # 1. info.yaml with attributes
-        info = ModelInfo(self.path + 'info.yaml', self.model_instance)
-        contents.append(info)
+        # 1. info files with attributes
+        head = [Direntry("."), Direntry("..")] + self.info_files()
 
         # 2. list of experiments
-        session = Session.object_session(self.model_instance)
-        experiments = session.query(Experiment).filter( \
-            Experiment.scientist_id == str(self.model_instance.id))
-        for exp in experiments:
-            contents.append(ExperimentDir(self.path + str(exp), exp))
-
-        return contents
+        listed = Listed(children_query(Experiment, 'scientist_id'), Experiment,
+                        'scientist_id', self.id, None,
+                        lambda child: ExperimentDir(self.path + child.name, child,
+                                                    session=self.session))
+        return head, listed, []
 
 
-class ExperimentDir(ModelDir):
+class ExperimentDir(PagedDir, ModelDir):
     """
     Class represents an Experiment folder.
     """
-    @logged
-    def list(self):
+    def contents(self):
         """
         Experiment folder contains:
-        - information about the experiment as info.yaml
+        - information about the experiment as info.{yaml,json,msgpack}
         - folders with all related tissue samples
-
-        :return:        a list of files and folders.
+        - the contents of the folder as <name>.tar
         """
-        contents = [Direntry("."), Direntry("..")]
+        # 1. info files with attributes
+        head = [Direntry("."), Direntry("..")] + self.info_files()
 
-        # 1. info.yaml with attributes
-        info = ModelInfo(self.path + 'info.yaml', self.model_instance)
-        contents.append(info)
+        # 2. list of tissue samples
+        listed = Listed(children_query(TissueSample, 'experiment_id'), TissueSample,
+                        'experiment_id', self.id, None,
+                        lambda child: TissueSampleDir(self.path + child.name, child,
+                                                      session=self.session))
 
-        # 2. list of experiments
-        session = Session.object_session(self.model_instance)
-        objs = session.query(TissueSample).filter( \
-            TissueSample.experiment_id == self.model_instance.id)
-        for obj in objs:
-            contents.append(TissueSampleDir(self.path + str(obj), obj))
+        # 3. the whole folder as tar archive
+        tail = [TarExport(self.path + (self.name + '.tar'), self.source, session=self.session)]
 
-        return contents
+        return head, listed, tail
 
 
 class TissueSampleDir(ModelDir):
@@ -205,21 +505,21 @@ class TissueSampleDir(ModelDir):
     def list(self):
         """
         Tissue Sample folder contains:
-        - information about the sample as info.yaml
+        - information about the sample as info.{yaml,json,msgpack}
         - animal information as animal.yaml
         - 'images' folder with image files
         - 'image_stacks' folder with image stacks
         - 'segmentations' folder with segmentations
         - 'electrophysiology' folder with ephys data?
         - 'neurons' folder with neurons analyzed in the scope of this sample
+        - the contents of the folder as <name>.tar
 
         :return:        a list of files and folders.
         """
         contents = [Direntry("."), Direntry("..")]
 
-        # 1. info.yaml with attributes
-        info = ModelInfo(self.path + 'info.yaml', self.model_instance)
-        contents.append(info)
+        # 1. info files with attributes
+        contents.extend(self.info_files())
         # TODO info.yaml should contain link to the Protocol!
 
         # 2. animal.yaml with Animal description
@@ -228,20 +528,18 @@ class TissueSampleDir(ModelDir):
             contents.append(animal)
 
         # 3. 'neurons' folder with neuron descriptions
-        info = Neurons(self.path + 'neurons', self.model_instance)
+        info = Neurons(self.path + 'neurons', self.source, session=self.session)
         contents.append(info)
 
         # 4. list of static folders for raw / processed data
-        static_descriptor = {
-            'images': MicroscopeImage,
-            'image_stacks': MicroscopeImageStack,
-            'segmentations': Segmentation,
-            'electrophysiology': Electrophysiology
-        }
-        for staticname, cls in static_descriptor.items():
-            staticdir = TSStaticDir(self.path + staticname, cls, self.model_instance)
+        for staticname, cls in STATIC_DIRS.items():
+            staticdir = TSStaticDir(self.path + staticname, cls, self.session, self.id)
             contents.append(staticdir)
 
+        # 5. the whole folder as tar archive
+        contents.append(TarExport(self.path + (self.name + '.tar'), self.source,
+                                  session=self.session))
+
         return contents
 
 
@@ -250,6 +548,12 @@ class Neurons(ModelDir):
     It's a static folder inside a certain Tissue Sample that contains all 
     neuronal descriptions, investigated within this sample.
     """
+    def getattr(self):
+        # the aggregates are those of the Tissue Sample
+        attr = super(Neurons, self).getattr()
+        attr.st_size, attr.st_nlink = self.DIRSIZE, 2
+        return attr
+
     @logged
     def list(self):
         """
@@ -258,69 +562,67 @@ class Neurons(ModelDir):
         :return:        a list of neuron files.
         """
         contents = [Direntry("."), Direntry("..")]
+        neurons = set()
         for nr in self.model_instance.neuro_representations:
             for neuron in nr.neurons:
-                contents.append(ModelInfo(self.path + str(neuron), neuron))
+                if neuron not in neurons:
+                    neurons.add(neuron)
+                    contents.append(ModelInfo(self.path + str(neuron), neuron))
 
         return contents
 
 
-class TSStaticDir(FuseFile):
+class TSStaticDir(PagedDir, FuseFile):
     """
     It's a static folder in the Tissue Sample that contains all elements of a
     certain type: images, image stacks, segmentations, ephys.
     """
-    def __init__(self, path, model, parent):
+    def __init__(self, path, model, session, parent_id):
+        """
+        :param model:       the model of the listed objects.
+        :param parent_id:   the id of the Tissue Sample.
+        """
         self.model = model
-        self.parent = parent
+        self.session = session
+        self.parent_id = parent_id
 
         mode = stat.S_IFDIR | 0755
         super(TSStaticDir, self).__init__(path, mode=mode)
 
-    @logged
-    def list(self):
+    def contents(self):
         """
         Contains all related objects of the type self.model.
-
-        :return:        a list of folders.
         """
-        contents = [Direntry("."), Direntry("..")]
-
-        session = Session.object_session(self.parent)
-        q = session.query(self.model)
-        for obj in q.filter(self.model.tissue_sample == self.parent):
-            objdir = NeuroRepresentationDir(self.path + str(obj), obj)
-            contents.append(objdir)
-
-        return contents
+        listed = Listed(children_query(self.model, 'tissue_sample_id'), self.model,
+                        'tissue_sample_id', self.parent_id, None,
+                        lambda child: NeuroRepresentationDir(self.path + child.name, child,
+                                                             session=self.session))
+        return [Direntry("."), Direntry("..")], listed, []
 
 
-class NeuroRepresentationDir(ModelDir):
+class NeuroRepresentationDir(PagedDir, ModelDir):
     """
     Class represents a generic NeuroRepresentation folder. It can represent a 
     single Image, Image Stack, Segmentation, or Ephys dataset.
     """
-    @logged
-    def list(self):
+    def contents(self):
         """
         Neuro Representation folder contains:
-        - information about the specific representation as info.yaml
+        - information about the specific representation as info.{yaml,json,msgpack}
         - all files related to this representation
-
-        :return:        a list of files.
         """
-        contents = [Direntry("."), Direntry("..")]
-
-        # 1. info.yaml with attributes
-        info = ModelInfo(self.path + 'info.yaml', self.model_instance)
-        contents.append(info)
+        # 1. info files with attributes
+        head = [Direntry("."), Direntry("..")] + self.info_files()
         # TODO display neuron connection inside the file!
 
-        # 2. list of all related Files
-        for f in self.model_instance.files:
-            contents.append(NormalFile(self.path + str(f), f))
-
-        return contents
+        # 2. list of all related Files, files still being ingested are hidden
+        q = children_query(File, 'neuro_representation_id') + \
+            (lambda q: q.filter(File.status == 'ready'))
+        listed = Listed(q, File, 'neuro_representation_id', self.id,
+                        lambda f: (f.st_mtime, f.st_ctime, f.st_size),
+                        lambda child: NormalFile(self.path + child.name, child,
+                                                 session=self.session))
+        return head, listed, []
 
 
 #-------------------------------------------------------------------------------
@@ -334,6 +636,10 @@ class NormalFile(ModelFile):
     """
 
     def getattr(self):
+        # the descriptor has the stat values of the file
+        attr = self.child_getattr()
+        if attr is not None:
+            return attr
         kwargs = {}
         kwargs['st_mode'] = int(self.mode)
         kwargs['st_size'] = self.model_instance.st_size
@@ -356,39 +662,295 @@ class NormalFile(ModelFile):
 class ModelInfo(ModelFile):
     """
     Class represents a info.yaml file with properties of an instance of a 
-    certain model.
+    certain model. Written data is committed when the file is closed (see
+    FileHandle).
     """
+    buffered = True
+
+    def __init__(self, path, obj, fmt='yaml', *args, **kwargs):
+        """
+        :param fmt:     the file format, one of Serializer.formats()
+        """
+        self.fmt = fmt
+        super(ModelInfo, self).__init__(path, obj, *args, **kwargs)
 
     def read(self, size=-1, offset=0):
         """
         Returns an attached object representation as YAML file (bytestring).
         """
-        return Serializer.serialize(self.model_instance) # binary?
+        return Serializer.dumps(self.model_instance, self.fmt) # binary?
 
-    def write(self, buf, offset=0):
+    @logged
+    def commit(self, data):
         """
-        Updates object information 
+        Updates the object from the complete written file in one
+        transaction.
 
-        :param buf:     a YAML representation of an object.
-        :type buf:      str
+        :param data:    a YAML (or JSON, MessagePack) representation of an object.
+        :type data:     str
 
-        :return:        0 on success or and negative error code.
+        :return:        0 on success or a negative error code.
         """
         try:
-            new = Serializer.deserialize(self.model_instance.__class__, buf)
-            new.id = self.model_instance.id
-
-        except Exception, e:
-            return -1 # TODO find a way to handle expceptions better..
+            attributes = Serializer.parse(data, self.fmt)
+        except Exception:
+            return -errno.EINVAL
+        if not isinstance(attributes, dict):
+            return -errno.EINVAL
+        attributes = attributes.get("attributes", attributes)
+
+        # only apply what was edited, values that are rendered as text
+        # (e.g. 'None' in YAML) would not survive the round trip
+        current = Serializer.to_dict(self.model_instance, typed=self.fmt != 'yaml')
+        changed = dict((k, v) for k, v in attributes.items()
+                       if current["attributes"].get(k) != v)
+        if not changed:
+            return 0
 
         session = Session.object_session(self.model_instance)
-        session.merge(new)
-        session.commit() # needed?
+        model = self.model_instance.__class__
+        for name, value in changed.items():
+            if value is not None and hasattr(model, name) and \
+                    name in Serializer.plan(model).deserialize:
+                dimension = cache.dimension_of(getattr(model, name).property.columns[0])
+                if dimension is not None and \
+                        value not in cache.dimension_names(session, dimension):
+                    return -errno.EINVAL
+
+        try:
+            Serializer.update(self.model_instance, changed)
+            session.commit()
+        except Exception:
+            session.rollback()
+            return -errno.EINVAL
 
         return 0
 
 
+class TarExport(ModelFile):
+    """
+    Class represents a virtual tar archive with the contents of an
+    Experiment or Tissue Sample folder: all info files and raw data files.
+    The archive is never built as a whole, each read produces only the
+    requested range (see TarStream).
+    """
+    # archive layouts by path with the versions of the tables they reflect,
+    # shared by the file objects of the same archive, least recently used
+    # first
+    streams = OrderedDict()
+    max_streams = 16
+    _lock = threading.Lock()
+    # the tables the archives are built from (see table_names())
+    _tables = None
+    # the layout used by this file object (see stream())
+    _tar = None
+
+    def tissue_samples(self):
+        """
+        Loads all tissue samples of the archive with their animals,
+        representations, neurons and files in one go.
+        """
+        obj = self.model_instance
+        if isinstance(obj, TissueSample):
+            condition = TissueSample.id == obj.id
+        else:
+            condition = TissueSample.experiment_id == obj.id
+        session = Session.object_session(obj)
+        return session.query(TissueSample).filter(condition).options(
+            orm.joinedload(TissueSample.animal),
+            orm.subqueryload(TissueSample.neuro_representations)
+               .subqueryload(NeuroRepresentation.files),
+            orm.subqueryload(TissueSample.neuro_representations)
+               .subqueryload(NeuroRepresentation.neurons))
+
+    def build(self):
+        """
+        Computes the layout of the archive, mirroring the folder structure.
+
+        :return:        a TarStream
+        """
+        def ts(time):
+            return calendar.timegm(time.timetuple()) if time else 0
+
+        def add_info(name, obj):
+            data = Serializer.serialize(obj)
+            if not isinstance(data, bytes):
+                data = data.encode('utf-8')
+            tar.add_data(name, data, ts(obj.mtime))
+
+        tar = TarStream()
+        root = self.name[:-len('.tar')]
+        samples = self.tissue_samples()
+        if isinstance(self.model_instance, TissueSample):
+            ts_root = root
+        else:
+            tar.add_dir(root, ts(self.model_instance.mtime))
+            add_info(root + '/info.yaml', self.model_instance)
+            ts_root = None
+
+        for sample in samples:
+            sample_dir = ts_root or root + '/' + str(sample)
+            tar.add_dir(sample_dir, ts(sample.mtime))
+            add_info(sample_dir + '/info.yaml', sample)
+            if sample.animal:
+                add_info(sample_dir + '/animal.yaml', sample.animal)
+
+            neurons = set()
+            tar.add_dir(sample_dir + '/neurons', ts(sample.mtime))
+            for nr in sample.neuro_representations:
+                for neuron in nr.neurons:
+                    if neuron not in neurons:
+                        neurons.add(neuron)
+                        add_info(sample_dir + '/neurons/' + str(neuron), neuron)
+
+            for staticname, cls in STATIC_DIRS.items():
+                static_dir = sample_dir + '/' + staticname
+                tar.add_dir(static_dir, ts(sample.mtime))
+                for nr in sample.neuro_representations:
+                    if not isinstance(nr, cls):
+                        continue
+                    nr_dir = static_dir + '/' + str(nr)
+                    tar.add_dir(nr_dir, ts(nr.mtime))
+                    add_info(nr_dir + '/info.yaml', nr)
+                    for f in nr.files:
+                        if f.status != 'ready':
+                            continue
+                        path = f.get_abs_path()
+                        try:
+                            on_disk = os.stat(path).st_size
+                        except OSError:
+                            on_disk = None
+                        if on_disk is None or on_disk < f.st_size:
+                            # left out rather than exported as zeros
+                            logging.error("%s is missing or too small, not exported to %s",
+                                          path, self.path)
+                            continue
+                        tar.add_file(nr_dir + '/' + str(f), path, f.st_size, ts(f.st_mtime))
+        tar.close()
+        return tar
+
+    @classmethod
+    def table_names(cls):
+        """ the names of the tables the archives are built from """
+        if cls._tables is None:
+            names = set()
+            for model in (Experiment, TissueSample, Animal, NeuroRepresentation, File, Neuron):
+                for mapper in orm.class_mapper(model).self_and_descendants:
+                    names.update(t.name for t in mapper.tables)
+            cls._tables = sorted(names)
+        return cls._tables
+
+    def stream(self):
+        """
+        The layout of the archive. It is computed again only if one of the
+        tables it is built from changed since. A file object keeps the
+        layout it used first, so all reads of an open file read the same
+        archive.
+
+        :return:        a TarStream
+        """
+        if self._tar is not None:
+            return self._tar
+        key = str(self.path)
+        version = cache.table_version(TarExport.table_names())
+        with TarExport._lock:
+            cached = TarExport.streams.pop(key, None)
+            if cached is not None:
+                TarExport.streams[key] = cached
+        if cached is not None and cached[0] == version:
+            tar = cached[1]
+        else:
+            tar = self.build()
+            with TarExport._lock:
+                TarExport.streams.pop(key, None)
+                TarExport.streams[key] = (version, tar)
+                while len(TarExport.streams) > TarExport.max_streams:
+                    TarExport.streams.popitem(last=False)
+        self._tar = tar
+        return tar
+
+    def __len__(self):
+        return self.stream().size
+
+    def read(self, size=-1, offset=0):
+        """
+        Returns a part of the archive.
+        """
+        tar = self.stream()
+        if size < 0:
+            size = tar.size
+        try:
+            return tar.read(size, offset)
+        except IOError as e:
+            logging.error("reading %s failed: %s", self.path, e)
+            return -errno.EIO
+
+
+class TableFile(FuseFile):
+    """
+    Class represents all objects of a model as one table file (see tables).
+    CSV tables can be written to update many objects at once.
+    """
+    def __init__(self, path, session, model, fmt='csv'):
+        """
+        :param model:   the model class of the table.
+        :param fmt:     the file format, one of tables.formats()
+        """
+        mode = stat.S_IFREG | (0644 if fmt == 'csv' else 0444)
+        super(TableFile, self).__init__(path, mode=mode)
+        self.session = session
+        self.model = model
+        self.fmt = fmt
+
+    @property
+    def buffered(self):
+        return self.fmt == 'csv'
+
+    def read(self, size=-1, offset=0):
+        """
+        Returns a part of the rendered table.
+        """
+        data = tables.render(self.session, self.model, self.fmt)
+        if size < 0:
+            return data[offset:]
+        return data[offset:offset + size]
+
+    @logged
+    def commit(self, data):
+        """
+        Updates all changed objects from the complete written table.
+
+        :return:        0 on success or -EINVAL if the table was rejected.
+        """
+        if not self.buffered:
+            return -errno.EOPNOTSUPP
+        if tables.write(self.session, self.model, data):
+            return 0
+        return -errno.EINVAL
+
+
+class TableErrors(FuseFile):
+    """
+    Class represents the errors of the last rejected update of a table.
+    """
+    def __init__(self, path, model):
+        super(TableErrors, self).__init__(path, mode=stat.S_IFREG | 0444)
+        self.model = model
+
+    def read(self, size=-1, offset=0):
+        data = tables.errors(self.model) or b''
+        if size < 0:
+            return data[offset:]
+        return data[offset:offset + size]
+
+
 class DimensionFile(FuseFile):
+    """
+    Class represents all entries of a dimension as YAML mapping from names
+    to description and comment. Written data is committed when the file is
+    closed (see FileHandle).
+    """
+    buffered = True
 
     def __init__(self, path, session, dimension):
         super(DimensionFile, self).__init__(path)
@@ -405,32 +967,48 @@ class DimensionFile(FuseFile):
 
     @logged
     def read(self, size=-1, offset=0):
-        dimlist = self.session.query(self.dimension).all()
-        dimdict = dict()
-        for d in dimlist:
-            dimdict[str(d.name)] = {str("description"): str(d.description), str("comment"): str(d.comment)}
-        return str(yaml.dump(dimdict))
+        data = cache.dimension(self.session, self.dimension).yaml
+        if size < 0:
+            return data[offset:]
+        return data[offset:offset + size]
 
     @logged
-    def write(self, buf, offset=0):
-        ret = len(buf)
+    def commit(self, data):
+        """
+        Compares the written entries with the stored ones and only inserts,
+        updates or deletes the entries that differ, in one transaction.
 
+        :return:        0 on success or a negative error code.
+        """
+        try:
+            entries = Serializer.parse(data, 'yaml') or {}
+        except yaml.YAMLError:
+            return -errno.EINVAL
+        if not isinstance(entries, dict) or \
+                not all(v is None or isinstance(v, dict) for v in entries.values()):
+            return -errno.EINVAL
+
+        # compare with the cached entries, load only what is changed
+        stored = cache.dimension(self.session, self.dimension).entries
+        new = dict((name, ((values or {}).get("description"), (values or {}).get("comment")))
+                   for name, values in entries.items())
+        changed = [name for name in stored if new.get(name) != stored[name]]
         try:
-            old_dims = self.session.query(self.dimension).all()
-            dim_data = yaml.load()
-            new_dims = []
-            for d in dim_data:
-                dim = self.dimension(name=d, description=dim_data[d]["description"],
-                                     comment=dim_data[d]["comment"])
-                new_dims.append(dim)
-            for dim in old_dims:
-                self.session.delete(dim)
-            self.session.flush()
-            for dim in new_dims:
-                self.session.add(dim)
+            if changed:
+                q = self.session.query(self.dimension).filter(self.dimension.name.in_(changed))
+                for dim in q:
+                    if dim.name in new:
+                        dim.description, dim.comment = new[dim.name]
+                    else:
+                        self.session.delete(dim)
+            for name in new:
+                if name not in stored:
+                    description, comment = new[name]
+                    self.session.add(self.dimension(name=name, description=description,
+                                                    comment=comment))
             self.session.commit()
-        except RuntimeError as ex:
-            ret = -errno.EIO
-
-        return ret
+        except Exception:
+            self.session.rollback()
+            return -errno.EIO
 
+        return 0
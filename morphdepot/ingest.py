@@ -0,0 +1,181 @@
+"""
+Workers that copy and hash files registered with
+NeuroRepresentation.enqueue_file().
+
+"""
+from __future__ import division, unicode_literals, print_function
+
+import os
+import time
+import socket
+import logging
+import datetime as dt
+import multiprocessing
+
+import sqlalchemy as sa
+
+import morphdepot.config as config
+from morphdepot.db import create_session
+from morphdepot.models.core import NeuroRepresentation, IngestJob
+from morphdepot.rawdata import file_checksum, ingest_file, link_object
+
+
+def claim_job(session, worker):
+    """
+    Claims the oldest job that is neither claimed by a running worker nor
+    failed too often.
+
+    :param session: an open session.
+    :param worker:  the name of the claiming worker.
+
+    :return:        the claimed IngestJob or None.
+    """
+    now = dt.datetime.now()
+    stale = now - dt.timedelta(seconds=config.INGEST['stale_after'])
+    table = IngestJob.__table__
+    unclaimed = (table.c.claimed_at == None) | (table.c.claimed_at < stale)
+
+    candidates = session.query(IngestJob.id) \
+        .filter(unclaimed, IngestJob.attempts < config.INGEST['max_attempts']) \
+        .order_by(IngestJob.id).limit(10).all()
+    for id, in candidates:
+        result = session.execute(
+            table.update().where((table.c.id == id) & unclaimed)
+            .values(claimed_at=now, worker=worker))
+        session.commit()
+        if result.rowcount == 1:
+            return session.query(IngestJob).get(id)
+    return None
+
+
+def process_job(session, job):
+    """
+    Copies and hashes the file of a job. The status of the file is
+    committed after every step, the job is removed when the file is ready.
+    A file that an earlier attempt moved already is only hashed.
+
+    :param session: an open session.
+    :param job:     a job claimed by claim_job().
+    """
+    f = job.file
+    source = job.source_path
+    target = f.get_abs_path()
+    try:
+        # left by an earlier attempt, the source is the only complete copy
+        # as long as it exists
+        if os.path.lexists(target) and os.path.exists(source):
+            os.remove(target)
+        if not os.path.exists(source) and os.path.exists(target):
+            # moved by an earlier attempt that failed afterwards
+            f.status = 'hashing'
+            session.commit()
+            checksum = file_checksum(target)
+        elif config.RAW_DATA['dedup']:
+            f.status = 'hashing'
+            session.commit()
+            checksum = file_checksum(source)
+            f.status = 'copying'
+            session.commit()
+            link_object(source, checksum, target, job.mode)
+        else:
+            f.status = 'copying'
+            session.commit()
+            ingest_file(source, target, job.mode)
+            f.status = 'hashing'
+            session.commit()
+            checksum = file_checksum(target)
+    except (IOError, OSError) as e:
+        session.rollback()
+        logging.warning("Ingest of %s failed: %s", source, e)
+        f.status = 'pending'
+        job.attempts += 1
+        job.error = str(e)
+        job.claimed_at = None
+        session.commit()
+        return
+
+    # other workers may add files to the representation concurrently. The
+    # write lock of its row is taken by an UPDATE before the checksum is
+    # read, SELECT ... FOR UPDATE does not lock on SQLite, so the checksums
+    # are added one after the other
+    table = NeuroRepresentation.__table__
+    session.execute(table.update().where(table.c.id == f.neuro_representation_id)
+                    .values(_checksum_sum=table.c._checksum_sum))
+    nr = session.query(NeuroRepresentation) \
+        .filter(NeuroRepresentation.id == f.neuro_representation_id) \
+        .populate_existing().one()
+    f._checksum = checksum
+    nr.replace_file_checksum(None, checksum)
+    f.status = 'ready'
+    session.delete(job)
+    session.commit()
+
+
+def release_job(session, id, worker):
+    """
+    Returns a job claimed by a worker to the queue, e.g. after a database
+    error, without counting it as failed attempt.
+
+    :param session: an open session without pending changes.
+    :param id:      the id of the job.
+    :param worker:  the name of the worker that claimed the job.
+    """
+    try:
+        job = session.query(IngestJob).get(id)
+        if job is not None and job.worker == worker:
+            job.claimed_at = None
+            job.worker = None
+            job.file.status = 'pending'
+            session.commit()
+    except sa.exc.SQLAlchemyError:
+        session.rollback()
+        logging.exception("Releasing ingest job %s failed", id)
+
+
+def run_worker(poll_interval=None):
+    """
+    Processes jobs until the process is terminated. After a database error
+    the job is released and the worker waits for poll_interval.
+
+    :param poll_interval:   seconds to wait if the queue is empty
+                            (default INGEST['poll_interval']).
+    """
+    poll_interval = poll_interval or config.INGEST['poll_interval']
+    worker = "%s:%i" % (socket.gethostname(), os.getpid())
+    session = create_session()
+    while True:
+        id = None
+        try:
+            job = claim_job(session, worker)
+            if job is None:
+                session.close()
+                time.sleep(poll_interval)
+                continue
+            id = job.id
+            process_job(session, job)
+        except sa.exc.SQLAlchemyError as e:
+            logging.warning("Ingest worker %s: database error: %s", worker, e)
+            session.rollback()
+            if id is not None:
+                release_job(session, id, worker)
+            session.close()
+            time.sleep(poll_interval)
+
+
+def serve(workers=None):
+    """
+    Runs a pool of worker processes.
+
+    :param workers: number of processes (default INGEST['workers']).
+    """
+    workers = workers or config.INGEST['workers']
+    processes = [multiprocessing.Process(target=run_worker, name="ingest-%i" % i)
+                 for i in range(workers)]
+    for p in processes:
+        p.start()
+    try:
+        for p in processes:
+            p.join()
+    finally:
+        for p in processes:
+            p.terminate()
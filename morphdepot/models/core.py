@@ -3,16 +3,17 @@ from __future__ import division, unicode_literals, print_function
 import datetime as dt
 import os
 import hashlib
-import shutil
 import uuid as uuid_package
 
 import sqlalchemy as sa
 import sqlalchemy.orm as orm
 
 from morphdepot.models import Base
-from morphdepot.models.utils.beanbags import IDMixin, Identity
+from morphdepot.models.utils.beanbags import IDMixin, AggregateMixin, Identity, UUID
 from morphdepot.models.utils import cut_to_render
 from morphdepot.models.dimensions import *
+from morphdepot.rawdata import file_checksum, representation_dir, \
+    ingest_file, link_object
 import morphdepot.config as config
 
 
@@ -20,7 +21,7 @@ import morphdepot.config as config
 # Analog World
 ##############
 
-class Scientist(IDMixin, Identity):
+class Scientist(IDMixin, AggregateMixin, Identity):
     __tablename__ = "scientists"
     __mapper_args__ = {'polymorphic_identity': 'Scientist'}
     # id = sa.Column(sa.ForeignKey('identities.id'), primary_key=True)
@@ -57,7 +58,7 @@ class Animal(Identity):
         return self.label
 
 
-class Experiment(Identity):
+class Experiment(AggregateMixin, Identity):
     __tablename__ = "experiments"
     __mapper_args__ = {'polymorphic_identity': 'Experiment'}
     id = sa.Column(sa.ForeignKey('identities.id'), primary_key=True)
@@ -77,7 +78,7 @@ class Experiment(Identity):
         return cut_to_render(name)
 
 
-class TissueSample(Identity):
+class TissueSample(AggregateMixin, Identity):
     __tablename__ = 'tissue_samples'
     __mapper_args__ = {'polymorphic_identity': 'TissueSample'}
     id = sa.Column(sa.ForeignKey('identities.id'), primary_key=True)
@@ -153,13 +154,15 @@ neuron_nr_maps = sa.Table(
     sa.Column('nr_id', sa.ForeignKey('neuro_representations.id'), primary_key=True))
 
 
-class NeuroRepresentation(Identity):
+class NeuroRepresentation(AggregateMixin, Identity):
     __tablename__ = 'neuro_representations'
     __mapper_args__ = {'polymorphic_identity': 'NeuroRepresentation'}
     id = sa.Column(sa.ForeignKey('identities.id'), primary_key=True)
     tissue_sample_id = sa.Column(sa.ForeignKey('tissue_samples.id'), nullable=False)
     label = sa.Column(sa.String(64), unique=True)
     _checksum = sa.Column(sa.String(40))
+    # sum of all file checksums modulo 2**160 (hex), see replace_file_checksum
+    _checksum_sum = sa.Column(sa.String(40))
 
     def __init__(self, label):
         self.label = label
@@ -189,39 +192,117 @@ class NeuroRepresentation(Identity):
     get_checksum = checksum
 
     def update_checksum(self):
-        print("updating checksum")
-        hash = hashlib.sha1()
+        """
+        Recomputes the checksum from the checksums of all files, files
+        deleted in the session are left out.
+        """
+        session = orm.object_session(self)
+        total = 0
         for file in self.files:
-            hash.update(file.checksum.encode('utf-8'))
-        self._checksum = hash.hexdigest()
-        print(self._checksum)
+            if session is not None and file in session.deleted:
+                continue
+            if file.checksum is not None:
+                total += int(file.checksum, 16)
+        self._set_checksum_sum(total)
+
+    def replace_file_checksum(self, old, new):
+        """
+        Updates the checksum after a file checksum changed. The checksum is
+        derived from the sum of all file checksums, so it does not depend on
+        the order of the files and can be updated without touching the other
+        files.
+
+        :param old:     the previous checksum of the file or None if the file
+                        is new.
+        :param new:     the new checksum of the file or None if the file was
+                        removed.
+        """
+        if self._checksum_sum is None:
+            # not yet migrated (see db.upgrade_schema) or created without
+            # __init__ like Electrophysiology, the file is already part of
+            # the files or left out if it was deleted
+            self.update_checksum()
+            return
+        total = int(self._checksum_sum, 16)
+        if old is not None:
+            total -= int(old, 16)
+        if new is not None:
+            total += int(new, 16)
+        self._set_checksum_sum(total)
+
+    def _set_checksum_sum(self, total):
+        self._checksum_sum = "%040x" % (total % 2**160)
+        self._checksum = hashlib.sha1(self._checksum_sum.encode('ascii')).hexdigest()
 
     def get_abs_path(self):
-        return os.path.join(config.RAW_DATA['root_dir'], str(self.id))
+        return representation_dir(self.id)
 
-    def add_file(self, path):
-        file_name = os.path.basename(path)
+    def _new_file(self, path):
         stat = os.stat(path)
         file_object = File(
-            file_name=file_name,
+            file_name=os.path.basename(path),
             st_atime=dt.datetime.fromtimestamp(stat.st_atime),
             st_mtime=dt.datetime.fromtimestamp(stat.st_mtime),
             st_ctime=dt.datetime.fromtimestamp(stat.st_ctime),
             st_blksize=stat.st_blksize,
             st_size=stat.st_size,
         )
-
         self.files.append(file_object)
-        shutil.copy2(path, os.path.join(self.get_abs_path(), file_name))
-        file_object.update_checksum()
+        return file_object
+
+    def add_file(self, path, mode=None):
+        """
+        Adds a file to the representation.
+
+        :param path:    the path of the file.
+        :param mode:    how to ingest the file, see rawdata.ingest_file()
+                        (default RAW_DATA['ingest_mode']).
+
+        :return:        the new File object.
+        """
+        file_object = self._new_file(path)
+        target = file_object.get_abs_path()
+        # a deleted file of the same name that was not collected yet
+        if os.path.lexists(target):
+            os.remove(target)
+        if config.RAW_DATA['dedup']:
+            checksum = file_checksum(path)
+            link_object(path, checksum, target, mode)
+            file_object._checksum = checksum
+            self.replace_file_checksum(None, checksum)
+        else:
+            ingest_file(path, target, mode)
+            file_object.update_checksum()
+        return file_object
+
+    def enqueue_file(self, path, mode=None):
+        """
+        Registers a file that is copied and hashed later by an ingest worker
+        (see morphdepot.ingest). The file is 'pending' until the worker is
+        done.
+
+        :param path:    the path of the file.
+        :param mode:    how to ingest the file, see rawdata.ingest_file()
+                        (default RAW_DATA['ingest_mode']).
+
+        :return:        the new File object.
+        """
+        file_object = self._new_file(os.path.abspath(path))
+        file_object.status = 'pending'
+        file_object.ingest_job = IngestJob(source_path=os.path.abspath(path), mode=mode)
         return file_object
 
     @staticmethod
     def auto_delete_directory(mapper, connection, target):
-        print(target.get_abs_path())
-        os.rmdir(target.get_abs_path())
+        # the directory is removed by rawdata.collect_tombstones() after commit
+        connection.execute(Tombstone.__table__.insert(),
+                           path=target.get_abs_path(), is_dir=True)
 
-sa.event.listen(NeuroRepresentation, 'before_delete', NeuroRepresentation.auto_delete_directory)
+sa.event.listen(NeuroRepresentation, 'before_delete', NeuroRepresentation.auto_delete_directory,
+                propagate=True)
+
+
+FILE_STATUSES = ('pending', 'copying', 'hashing', 'ready')
 
 
 class File(Identity):
@@ -237,6 +318,10 @@ class File(Identity):
     st_blksize = sa.Column(sa.Integer)
     st_size = sa.Column(sa.BigInteger)
     _checksum = sa.Column(sa.String(40))
+    # one of FILE_STATUSES, only 'ready' files are complete on disk. Files
+    # are 'copying' before 'hashing', with RAW_DATA['dedup'] the other way
+    # round, the checksum names the stored object to link
+    status = sa.Column(sa.String(16), nullable=False, default='ready')
     __table_args__ = (
         sa.CheckConstraint(st_size >= 0, name='check_filesize_positive'),
         {})
@@ -259,19 +344,28 @@ class File(Identity):
         return os.path.join(self.neuro_representation.get_abs_path(), self.file_name)
 
     def update_checksum(self):
-        f = open(self.get_abs_path())
-        hash = hashlib.sha1()
-        hash.update(f.read().encode('utf-8'))
-        f.close()
-        self._checksum = hash.hexdigest()
-        self.neuro_representation.update_checksum()
+        old = self._checksum
+        self._checksum = file_checksum(self.get_abs_path())
+        self.neuro_representation.replace_file_checksum(old, self._checksum)
 
     # Triggers
     @staticmethod
     def delete_file(mapper, connection, target):
-        os.remove(target.get_abs_path())
+        # the file is removed by rawdata.collect_tombstones() after commit
+        connection.execute(Tombstone.__table__.insert(),
+                           path=target.get_abs_path(), is_dir=False,
+                           file_id=target.id, checksum=target.checksum)
+
+    @staticmethod
+    def remove_deleted_checksums(session, flush_context, instances):
+        for obj in session.deleted:
+            if isinstance(obj, File):
+                nr = obj.neuro_representation
+                if nr is not None and nr not in session.deleted:
+                    nr.replace_file_checksum(obj.checksum, None)
 
 sa.event.listen(File, 'after_delete', File.delete_file)
+sa.event.listen(orm.Session, 'before_flush', File.remove_deleted_checksums)
 
 
 # GinJang: Method-Information
@@ -315,6 +409,81 @@ class Permisson(Base):
         backref=orm.backref('permission', uselist=False)
     )
 
+
+# Add On: Ingest Queue
+######################
+
+class IngestJob(Base):
+    """
+    A file waiting to be copied into RAW_DATA['root_dir'] by an ingest
+    worker. A job is claimed by a worker by setting claimed_at; jobs of
+    workers that died are claimed again after INGEST['stale_after'] seconds.
+    """
+    __tablename__ = "ingest_jobs"
+    id = sa.Column(sa.Integer, primary_key=True, autoincrement=True)
+    file_id = sa.Column(sa.ForeignKey('files.id'), nullable=False, unique=True)
+    source_path = sa.Column(sa.String(1024), nullable=False)
+    mode = sa.Column(sa.String(16))
+    ctime = sa.Column(sa.DateTime, default=dt.datetime.now)
+    claimed_at = sa.Column(sa.DateTime)
+    worker = sa.Column(sa.String(64))
+    attempts = sa.Column(sa.Integer, nullable=False, default=0)
+    error = sa.Column(sa.Text)
+
+    # relationships
+    file = orm.relationship(
+        "File",
+        backref=orm.backref('ingest_job', uselist=False, cascade="all,delete")
+    )
+
+
+# Add On: Tombstones
+####################
+
+class Tombstone(Base):
+    """
+    A file or directory below RAW_DATA['root_dir'] that belongs to a deleted
+    object. Tombstones are written in the same transaction as the deletion,
+    so they vanish on rollback; nothing is removed before the commit.
+    """
+    __tablename__ = "tombstones"
+    id = sa.Column(sa.Integer, primary_key=True, autoincrement=True)
+    path = sa.Column(sa.String(1024), nullable=False)
+    is_dir = sa.Column(sa.Boolean, nullable=False, default=False)
+    # id of a deleted File, the file is kept as long as the row exists
+    file_id = sa.Column(UUID)
+    # checksum of a file, used to release it from the content-addressed store
+    checksum = sa.Column(sa.String(40))
+    ctime = sa.Column(sa.DateTime, default=dt.datetime.now)
+
+
+class Change(Base):
+    """
+    An entry of the change feed: a table or an object that was changed by a
+    transaction, recorded in the same transaction (see
+    cache.record). Processes that cache data of the database read the feed
+    to invalidate their caches (see changes.Poller).
+    """
+    __tablename__ = "changes"
+    # never reuse a sequence number, even if the latest changes are deleted
+    __table_args__ = {'sqlite_autoincrement': True}
+    seq = sa.Column(sa.Integer, primary_key=True, autoincrement=True)
+    # 'table' or 'object'
+    kind = sa.Column(sa.String(16), nullable=False)
+    # name of the table or of the class of the object
+    name = sa.Column(sa.String(64), nullable=False)
+    # an attribute of the object that refers to another object and the id
+    # of the latter, or None
+    attribute = sa.Column(sa.String(64))
+    key = sa.Column(sa.String(36))
+    ctime = sa.Column(sa.DateTime, default=dt.datetime.now, nullable=False, index=True)
+
+# record all changes made through the models in the change feed
+import morphdepot.cache
+# maintain the aggregates of Scientist, Experiment, TissueSample and
+# NeuroRepresentation
+import morphdepot.aggregates
+
 # from sqlalchemy.ext.associationproxy import association_proxy
 #
 # Identity.oga = association_proxy('permission', 'oga')
@@ -16,7 +16,7 @@ electrophysiology__response_property__maps = sa.Table(
 
 class Electrophysiology(NeuroRepresentation):
     __tablename__ = 'electrophysiologies'
-    __mapper_args__ = {'polymorphic_identity': 'Electrophysiology'}
+    __mapper_args__ = {'polymorphic_identity': 'Electrophysiology', 'polymorphic_load': 'selectin'}
 
     id = sa.Column(sa.ForeignKey('neuro_representations.id'), primary_key=True)
     spontaneous_activity = sa.Column(sa.ForeignKey('spontaneous_activities.name'))
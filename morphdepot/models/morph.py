@@ -33,7 +33,7 @@ segmentation__general_param__maps = sa.Table(
 
 class Segmentation(NeuroRepresentation):
     __tablename__ = 'segmentations'
-    __mapper_args__ = {'polymorphic_identity': 'Segmentation'}
+    __mapper_args__ = {'polymorphic_identity': 'Segmentation', 'polymorphic_load': 'selectin'}
     id = sa.Column(sa.ForeignKey('neuro_representations.id'), primary_key=True)
     microscope_image_stack_id = sa.Column(
         sa.ForeignKey('microscope_image_stacks.id'),
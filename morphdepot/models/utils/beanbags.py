@@ -1,4 +1,6 @@
 # -*- coding: utf-8 -*-
+import sys
+import binascii
 import datetime as dt
 import uuid as uuid_package
 import sqlalchemy as sa
@@ -7,6 +9,8 @@ from sqlalchemy.dialects.postgresql import UUID as PG_UUID
 from sqlalchemy.ext.declarative import declared_attr
 from morphdepot.models import Base
 from morphdepot.models.utils.interfaces import Identifiable
+from morphdepot.serializer import Serializer
+import morphdepot.config as config
 
 __author__ = 'Philipp Rautenberg'
 
@@ -34,11 +38,52 @@ class IDMixin(object):
         return sa.Column(sa.ForeignKey('identities.id'), primary_key=True)
 
 
+class AggregateMixin(object):
+    """
+    Aggregates of the objects below an object that is a folder of the file
+    system, maintained by every flush (see morphdepot.aggregates)
+    """
+    # objects listed in the folder of the object
+    child_count = sa.Column(sa.Integer, nullable=False, default=0)
+    # number and total size of the ready files below the object
+    file_count = sa.Column(sa.Integer, nullable=False, default=0)
+    byte_count = sa.Column(sa.BigInteger, nullable=False, default=0)
+
+
+def uuid_from_int(value):
+    """
+    A uuid.UUID from its 128 bit integer value, without the parsing and
+    checks of the UUID constructor.
+    """
+    obj = object.__new__(uuid_package.UUID)
+    object.__setattr__(obj, 'int', value)
+    if hasattr(uuid_package, 'SafeUUID'):
+        object.__setattr__(obj, 'is_safe', uuid_package.SafeUUID.unknown)
+    return obj
+
+
+def uuid_from_hex(value):
+    """ a uuid.UUID from 32 hex digits, dashes are ignored """
+    return uuid_from_int(int(value.replace('-', ''), 16))
+
+
+if sys.version_info[0] == 2:
+    def uuid_from_bytes(value):
+        """ a uuid.UUID from 16 bytes (big-endian) """
+        return uuid_from_int(int(binascii.hexlify(value), 16))
+else:
+    def uuid_from_bytes(value):
+        """ a uuid.UUID from 16 bytes (big-endian) """
+        return uuid_from_int(int.from_bytes(value, 'big'))
+
+
 class UUID(TypeDecorator):
     """Platform-independent UUID type.
 
     Uses Postgresql's UUID type, otherwise uses
-    CHAR(32), storing as stringified hex values.
+    CHAR(32), storing as stringified hex values, or BINARY(16) if
+    config.DB['uuid_storage'] is 'binary'. Existing SQLite databases are
+    converted with 'morph_admin.py uuids' (see db.migrate_uuids).
 
     """
     impl = CHAR
@@ -46,26 +91,67 @@ class UUID(TypeDecorator):
     def load_dialect_impl(self, dialect):
         if dialect.name == 'postgresql':
             return dialect.type_descriptor(PG_UUID())
+        elif config.DB['uuid_storage'] == 'binary':
+            return dialect.type_descriptor(sa.BINARY(16))
         else:
             return dialect.type_descriptor(CHAR(32))
 
+    def __store(self, dialect):
+        """ the function that produces the stored value of a uuid.UUID """
+        if dialect.name == 'postgresql':
+            return str
+        elif isinstance(self.impl, sa.BINARY):
+            return lambda value: value.bytes
+        else:
+            return lambda value: value.hex
+
+    def __load(self):
+        """ the function that produces a uuid.UUID from a stored value """
+        if isinstance(self.impl, sa.BINARY):
+            return uuid_from_bytes
+        return uuid_from_hex
+
     def process_bind_param(self, value, dialect):
         if value is None:
             return value
-        elif dialect.name == 'postgresql':
-            return str(value)
-        else:
-            if not isinstance(value, uuid_package.UUID):
-                return "%.32x" % uuid_package.UUID(value)
-            else:
-                # hexstring
-                return "%.32x" % value
+        if not isinstance(value, uuid_package.UUID):
+            value = uuid_package.UUID(value)
+        return self.__store(dialect)(value)
 
     def process_result_value(self, value, dialect):
         if value is None:
             return value
-        else:
-            return uuid_package.UUID(value)
+        return self.__load()(value)
+
+    # The processors are created once per dialect, with the conversions of
+    # the storage in use, instead of deciding on every value.
+
+    def bind_processor(self, dialect):
+        store = self.__store(dialect)
+        impl_processor = self.impl.bind_processor(dialect)
+
+        def process(value):
+            if value is None:
+                return value
+            if not isinstance(value, uuid_package.UUID):
+                value = uuid_package.UUID(value)
+            value = store(value)
+            if impl_processor is not None:
+                value = impl_processor(value)
+            return value
+        return process
+
+    def result_processor(self, dialect, coltype):
+        load = self.__load()
+        impl_processor = self.impl.result_processor(dialect, coltype)
+
+        def process(value):
+            if impl_processor is not None:
+                value = impl_processor(value)
+            if value is None:
+                return value
+            return load(value)
+        return process
 
 
 class UUIDMixin(object):
@@ -85,6 +171,18 @@ class Identity(UUIDMixin, Base, Identifiable):
     _dto_type = sa.Column('dto_type', sa.String, nullable=False)
     __mapper_args__ = {'polymorphic_on': _dto_type}
 
+    def get_yaml(self):
+        return Serializer.serialize(self)
+
+    def set_by_yaml(self, yaml_string):
+        Serializer.update(self, Serializer.parse(yaml_string, 'yaml'))
+
+    def get_json(self):
+        return Serializer.serialize_json(self)
+
+    def set_by_json(self, json_string):
+        Serializer.update(self, Serializer.parse(json_string, 'json'))
+
     @staticmethod
     def update_mtime(mapper, connection, target):
         target.mtime = dt.datetime.now()
@@ -2,76 +2,171 @@
 
 from __future__ import division, unicode_literals, print_function
 
+import os
 import errno
+from contextlib import contextmanager
 import config
-import sqlalchemy
-import sqlalchemy.orm as orm
+import cache
+import db
 import fuse
 from log import logged
-import models.morph
-from models.morph import Base
 from defaultfs import DefaultFS
+from fshelper import FileHandle
 from fsmapping import RootDir
+from rawdata import Collector
+from changes import Poller
 
 
 class MorphFS(DefaultFS):
     """
     Main fuse interface of the morphdepot file system.
+
+    Every operation uses a new session that is closed when the operation
+    is done, open files keep their session until they are released. So no
+    objects are kept longer than needed and changes made by others are
+    seen with the next operation. Data that is worth keeping between
+    operations is cached explicitly (see cache), and invalidated by the
+    changes of other processes as well (see changes).
     """
 
     @logged
     def __init__(self, *args, **kwargs):
         super(MorphFS, self).__init__(*args, **kwargs)
-        s = self.init_session()
-        self.__root = RootDir(s)
+        engine = db.create_engine(
+            recreate_schema=config.DB['type'] == "postgresql" and config.DB['pg_recreate_schema'])
+        self.__Session = db.sessionmaker(engine)
+        self.__collector = Collector(engine)
+        self.__collector.observe(self.__Session)
+        self.__poller = Poller(engine)
+        # sizes of buffered files truncated before they are opened
+        self.__truncated = {}
+
+    @logged
+    def fsinit(self):
+        # started here, because threads don't survive daemonization
+        self.__collector.start()
+        self.__poller.start()
+
+    @contextmanager
+    def session(self):
+        """
+        A session for one operation, closed afterwards.
+        """
+        session = self.open_session()
+        try:
+            yield session
+        finally:
+            self.close_session(session)
+
+    def open_session(self):
+        cache.count('sessions')
+        return self.__Session()
 
-    @property
-    def root(self):
-        return self.__root
+    def close_session(self, session):
+        cache.observe('identity_map', len(session.identity_map))
+        session.close()
+
+    def resolve(self, path, session):
+        return RootDir(session).resolve(path)
 
     @logged
     def getattr(self, path):
-        f = self.root.resolve(path)
-        if f is not None:
-            return f.getattr()
-        else:
-            return -errno.ENOENT
+        with self.session() as session:
+            f = self.resolve(path, session)
+            if f is not None:
+                return f.getattr()
+            else:
+                return -errno.ENOENT
 
     @logged
     def open(self, path, flags):
-        f = self.root.resolve(path)
+        session = self.open_session()
+        f = self.resolve(path, session)
         if f is not None:
             if f.is_file():
                 # TODO check permissions
-                return None
+                size = self.__truncated.pop(path, None)
+                if flags & os.O_TRUNC:
+                    size = 0
+                elif not flags & (os.O_WRONLY | os.O_RDWR):
+                    size = None
+                fh = FileHandle(f, size)
+                fh.session = session
+                return fh
             else:
+                self.close_session(session)
                 return -errno.EOPNOTSUPP
         else:
+            self.close_session(session)
             return -errno.ENOENT
 
     @logged
     def read(self, path, size, offset, fh=None):
-        f = self.root.resolve(path)
-        if f is not None:
-            if f.is_file():
-                # TODO check permissions
-                return f.read(size, offset)
+        if fh is not None:
+            return fh.read(size, offset)
+        with self.session() as session:
+            f = self.resolve(path, session)
+            if f is not None:
+                if f.is_file():
+                    # TODO check permissions
+                    return f.read(size, offset)
+                else:
+                    return -errno.EOPNOTSUPP
             else:
-                return -errno.EOPNOTSUPP
-        else:
-            return -errno.ENOENT
+                return -errno.ENOENT
 
     @logged
     def write(self, path, buf, offset, fh=None):
-        f = self.root.resolve(path)
-        if f is not None:
-            if f.is_file():
-                # TODO check permissions
-                return f.write(buf, offset)
+        if fh is not None:
+            return fh.write(buf, offset)
+        with self.session() as session:
+            f = self.resolve(path, session)
+            if f is not None:
+                if f.is_file():
+                    # TODO check permissions
+                    return f.write(buf, offset)
+                else:
+                    return -errno.EOPNOTSUPP
             else:
-                return -errno.EOPNOTSUPP
-        else:
-            return -errno.ENOENT
+                return -errno.ENOENT
+
+    @logged
+    def truncate(self, path, size):
+        """
+        Buffered files are truncated when they are opened next, editors
+        usually truncate a file right before they open it for writing.
+        """
+        with self.session() as session:
+            f = self.resolve(path, session)
+            if f is not None:
+                if f.is_file() and f.buffered:
+                    self.__truncated[path] = size
+                    return 0
+                else:
+                    return -errno.EOPNOTSUPP
+            else:
+                return -errno.ENOENT
+
+    @logged
+    def ftruncate(self, path, size, fh=None):
+        if fh is not None:
+            return fh.truncate(size)
+        return self.truncate(path, size)
+
+    @logged
+    def flush(self, path, fh=None):
+        if fh is not None:
+            return fh.flush()
+        return 0
+
+    @logged
+    def release(self, path, flags, fh=None):
+        if fh is not None:
+            try:
+                return fh.flush()
+            finally:
+                self.close_session(fh.session)
+        return 0
 
     @logged
     def opendir(self, path):
@@ -81,32 +176,20 @@ class MorphFS(DefaultFS):
 
     @logged
     def readdir(self, path, offset, dh=None):
-        f = self.root.resolve(path)
-        if f is not None and f.is_dir():
-            list = f.list()
-            for i in list:
-                yield i
+        with self.session() as session:
+            f = self.resolve(path, session)
+            if f is not None and f.is_dir():
+                for entry in f.list_from(offset):
+                    yield entry
 
     @logged
     def access(self, path, flags):
-        f = self.root.resolve(path)
-        if f is not None:
-            return f.access(flags)
-        else:
-            return -errno.ENOENT
-
-    @logged
-    def init_session(self):
-        engine = sqlalchemy.create_engine(config.DB['url'], echo=config.DB['echo'])
-        if config.DB['type'] == "sqlite":
-            engine.execute("PRAGMA foreign_keys=ON")
-        elif config.DB['type'] == "postgresql":
-            if config.DB['pg_recreate_schema']:
-                engine.execute("DROP SCHEMA %s CASCADE;" % (config.DB['schema']))
-                engine.execute("CREATE SCHEMA %s;" % (config.DB['schema']))
-        Session = orm.sessionmaker(bind=engine)
-        Base.metadata.create_all(engine)
-        return Session()
+        with self.session() as session:
+            f = self.resolve(path, session)
+            if f is not None:
+                return f.access(flags)
+            else:
+                return -errno.ENOENT
 
     def __repr__(self):
         return 'MorphFS()'
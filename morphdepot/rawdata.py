@@ -0,0 +1,480 @@
+"""
+Helpers for the raw data files stored below config.RAW_DATA['root_dir'].
+
+"""
+from __future__ import division, unicode_literals, print_function
+
+import io
+import os
+import time
+import errno
+import logging
+import threading
+import fcntl
+import shutil
+import hashlib
+import uuid as uuid_package
+from multiprocessing.dummy import Pool as ThreadPool
+
+import sqlalchemy as sa
+import sqlalchemy.orm as orm
+
+import morphdepot.config as config
+
+# ioctl request to share the extents of a file (linux/fs.h)
+FICLONE = 0x40049409
+
+INGEST_MODES = ('copy', 'reflink', 'hardlink', 'move')
+
+
+def shard_path(root, name, fanout=None):
+    """
+    Computes the path of an entry in a directory tree with a fixed fan-out.
+    With a fan-out of (2, 2) the name 'abcdef' is stored as 'ab/cd/abcdef',
+    which keeps the number of entries per directory small.
+
+    :param root:    the root directory of the tree.
+    :param name:    the name of the entry.
+    :param fanout:  the widths of the name prefixes used as intermediate
+                    directories (default RAW_DATA['fanout']).
+
+    :return:        the absolute path of the entry.
+    """
+    if fanout is None:
+        fanout = config.RAW_DATA['fanout']
+    parts = [root]
+    pos = 0
+    for width in fanout:
+        parts.append(name[pos:pos + width])
+        pos += width
+    parts.append(name)
+    return os.path.join(*parts)
+
+
+def representation_dir(id, fanout=None):
+    """
+    The directory that holds the files of a neuro representation.
+
+    :param id:      the id of the neuro representation.
+    :param fanout:  see shard_path()
+
+    :return:        the absolute path of the directory.
+    """
+    return shard_path(config.RAW_DATA['root_dir'], str(id), fanout)
+
+
+def _copy_data(src, dst, reflink):
+    with io.open(src, 'rb') as fsrc:
+        with io.open(dst, 'wb') as fdst:
+            if reflink:
+                try:
+                    fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                    return
+                except (IOError, OSError):
+                    pass
+
+            copy_file_range = getattr(os, 'copy_file_range', None)
+            if copy_file_range is not None:
+                try:
+                    while copy_file_range(fsrc.fileno(), fdst.fileno(), 1 << 30):
+                        pass
+                    return
+                except OSError as e:
+                    if e.errno not in (errno.ENOSYS, errno.EXDEV, errno.EINVAL,
+                                       errno.EOPNOTSUPP):
+                        raise
+                    fsrc.seek(0)
+                    fdst.seek(0)
+                    fdst.truncate()
+
+            shutil.copyfileobj(fsrc, fdst, config.RAW_DATA['chunk_size'])
+
+
+def ingest_file(src, dst, mode=None):
+    """
+    Puts a file into the raw data directory. Modes that are not supported
+    for the given paths fall back to the next cheaper one: a hard link
+    falls back to a reflink, a reflink to copy_file_range() and that to a
+    plain copy. Copies preserve the file times like shutil.copy2().
+
+    :param src:     the file to ingest.
+    :param dst:     the destination path.
+    :param mode:    one of 'copy', 'reflink' (share extents on XFS or btrfs),
+                    'hardlink' or 'move' (default RAW_DATA['ingest_mode']).
+    """
+    mode = mode or config.RAW_DATA['ingest_mode']
+    if mode not in INGEST_MODES:
+        raise ValueError("Unknown ingest mode: %s" % mode)
+
+    if mode == 'move':
+        try:
+            os.rename(src, dst)
+            return
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+    elif mode == 'hardlink':
+        try:
+            os.link(src, dst)
+            return
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+
+    _copy_data(src, dst, reflink=(mode != 'copy'))
+    shutil.copystat(src, dst)
+    if mode == 'move':
+        os.remove(src)
+
+
+def object_path(checksum):
+    """
+    The path of a file in the content-addressed store.
+
+    :param checksum:    the checksum of the file content.
+
+    :return:            the absolute path of the stored object.
+    """
+    store = os.path.join(config.RAW_DATA['root_dir'], '.objects')
+    return shard_path(store, checksum, (2, 2))
+
+
+def link_object(path, checksum, target, mode=None):
+    """
+    Makes the content of a file available at target through the
+    content-addressed store. The file is only ingested if the store does not
+    yet contain an object with the given checksum; target is created as
+    hard link to the stored object.
+
+    :param path:        the file to store.
+    :param checksum:    the checksum of the file.
+    :param target:      the path of the new link.
+    :param mode:        the ingest mode, see ingest_file().
+    """
+    mode = mode or config.RAW_DATA['ingest_mode']
+    obj = object_path(checksum)
+    while True:
+        if not os.path.exists(obj):
+            parent = os.path.dirname(obj)
+            if not os.path.isdir(parent):
+                try:
+                    os.makedirs(parent)
+                except OSError:
+                    if not os.path.isdir(parent):
+                        raise
+            tmp = "%s.%s.tmp" % (obj, uuid_package.uuid4().hex)
+            ingest_file(path, tmp, mode)
+            os.rename(tmp, obj)
+        try:
+            os.link(obj, target)
+            if mode == 'move' and os.path.exists(path):
+                os.remove(path)
+            return
+        except OSError as e:
+            # the object was released in the meantime
+            if e.errno != errno.ENOENT:
+                raise
+
+
+def release_object(checksum):
+    """
+    Removes an object from the content-addressed store. The caller makes
+    sure that no file refers to it anymore (see collect_tombstones()); the
+    number of links of the object does not tell, the source of a file
+    ingested as hard link links to it as well.
+
+    :param checksum:    the checksum of the object.
+    """
+    try:
+        os.remove(object_path(checksum))
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+def file_checksum(path, chunk_size=None, rate=None):
+    """
+    Computes the SHA1 checksum of a file. The file is read in binary mode
+    in chunks of a fixed size into one reused buffer, so memory usage does
+    not depend on the size of the file.
+
+    :param path:        path of the file to hash.
+    :param chunk_size:  bytes to read at once (default RAW_DATA['chunk_size']).
+    :param rate:        maximum read rate in bytes per second or None.
+
+    :return:            the hex digest of the file content.
+    """
+    chunk_size = chunk_size or config.RAW_DATA['chunk_size']
+    hash = hashlib.sha1()
+    buf = bytearray(chunk_size)
+    view = memoryview(buf)
+    start = time.time()
+    total = 0
+    with io.open(path, 'rb', buffering=0) as f:
+        n = f.readinto(buf)
+        while n:
+            hash.update(view[:n])
+            if rate:
+                total += n
+                delay = total / rate - (time.time() - start)
+                if delay > 0:
+                    time.sleep(delay)
+            n = f.readinto(buf)
+    return hash.hexdigest()
+
+
+def rehash_files(session, batch_size=100):
+    """
+    Recomputes the checksums of all registered files, e.g. of files that
+    were hashed in text mode by older versions, and afterwards the checksums
+    of all neuro representations. Changes are committed after every batch.
+    Databases of older versions have to be upgraded first (see
+    db.upgrade_schema).
+
+    :param session:     an open session.
+    :param batch_size:  number of files per transaction.
+
+    :return:            a list of (id, path, checksum) tuples of the files
+                        whose checksum changed.
+    """
+    from morphdepot.models.core import File
+
+    changed = []
+    last = None
+    while True:
+        q = session.query(File).filter(File.status == 'ready')
+        if last is not None:
+            q = q.filter(File.id > last)
+        files = q.order_by(File.id).limit(batch_size).all()
+        if not files:
+            break
+        for f in files:
+            old = f.checksum
+            f.update_checksum()
+            if f.checksum != old:
+                changed.append((f.id, f.get_abs_path(), f.checksum))
+        last = files[-1].id
+        session.commit()
+
+    update_representation_checksums(session, batch_size)
+    return changed
+
+
+def update_representation_checksums(session, batch_size=100):
+    """
+    Recomputes the checksums of all neuro representations from the
+    checksums of their files. Changes are committed after every batch.
+
+    :param session:     an open session.
+    :param batch_size:  number of representations per transaction.
+    """
+    from morphdepot.models.core import NeuroRepresentation
+
+    last = None
+    while True:
+        q = session.query(NeuroRepresentation)
+        if last is not None:
+            q = q.filter(NeuroRepresentation.id > last)
+        nrs = q.order_by(NeuroRepresentation.id).limit(batch_size).all()
+        if not nrs:
+            break
+        for nr in nrs:
+            nr.update_checksum()
+        last = nrs[-1].id
+        session.commit()
+
+
+def relayout(session, old_fanout, new_fanout=None, threads=8):
+    """
+    Moves the directories of all neuro representations from one fan-out
+    layout to another one. Directories are renamed in parallel, intermediate
+    directories of the old layout that become empty are removed.
+
+    :param session:     an open session.
+    :param old_fanout:  the fan-out the data is currently stored with.
+    :param new_fanout:  the target fan-out (default RAW_DATA['fanout']).
+    :param threads:     number of concurrent renames.
+
+    :return:            the number of moved directories.
+    """
+    from morphdepot.models.core import NeuroRepresentation
+
+    if new_fanout is None:
+        new_fanout = config.RAW_DATA['fanout']
+    root = config.RAW_DATA['root_dir']
+
+    def move(id):
+        src = representation_dir(id, old_fanout)
+        dst = representation_dir(id, new_fanout)
+        if src == dst or not os.path.isdir(src):
+            return 0
+        parent = os.path.dirname(dst)
+        if not os.path.isdir(parent):
+            try:
+                os.makedirs(parent)
+            except OSError:
+                if not os.path.isdir(parent):
+                    raise
+        os.rename(src, dst)
+
+        parent = os.path.dirname(src)
+        while parent != root:
+            try:
+                os.rmdir(parent)
+            except OSError:
+                break
+            parent = os.path.dirname(parent)
+        return 1
+
+    ids = [id for id, in session.query(NeuroRepresentation.id)]
+    pool = ThreadPool(threads)
+    try:
+        return sum(pool.map(move, ids))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _remove(entry):
+    path, is_dir, checksum = entry
+    try:
+        if is_dir:
+            os.rmdir(path)
+        elif path is not None:
+            try:
+                os.remove(path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+        # released even if the link was removed by an earlier run, the
+        # checksum is None if other files have the same content
+        if checksum is not None:
+            release_object(checksum)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            logging.warning("Unable to remove %s: %s", path, e)
+            return False
+    return True
+
+
+def _unreferenced(session, tombstones):
+    """
+    The entries of _remove() for file tombstones: the path is None if the
+    file still exists or another file was added under its path, the
+    checksum is None if other files have the same content.
+    """
+    from morphdepot.models.core import File
+
+    ids = [t.file_id for t in tombstones if t.file_id is not None]
+    existing = set()
+    if ids:
+        existing = set(id for id, in session.query(File.id).filter(File.id.in_(ids)))
+    names = set(os.path.basename(t.path) for t in tombstones)
+    used = set(os.path.join(representation_dir(nr_id), name) for nr_id, name in
+               session.query(File.neuro_representation_id, File.file_name)
+               .filter(File.file_name.in_(names)))
+    checksums = set(t.checksum for t in tombstones if t.checksum is not None)
+    referenced = set()
+    if checksums:
+        referenced = set(c for c, in session.query(File._checksum)
+                         .filter(File._checksum.in_(checksums)).distinct())
+
+    entries = []
+    for t in tombstones:
+        if t.file_id in existing:
+            logging.warning("Not removing %s, its file %s still exists", t.path, t.file_id)
+            entries.append((None, False, None))
+            continue
+        entries.append((None if t.path in used else t.path, False,
+                        None if t.checksum in referenced else t.checksum))
+    return entries
+
+
+def collect_tombstones(session, batch_size=1000, threads=None):
+    """
+    Removes the files and directories of deleted objects, as recorded in
+    the tombstones table. Files are removed before directories; every batch
+    is removed concurrently and its tombstones are deleted in one
+    transaction. Tombstones of entries that could not be removed are kept
+    for the next run. A file is only removed if its File row is gone and
+    no other file was added under its path, objects of the
+    content-addressed store are released with the last file that has their
+    checksum.
+
+    :param session:     an open session.
+    :param batch_size:  number of tombstones processed at once.
+    :param threads:     number of concurrent removals
+                        (default RAW_DATA['collect_threads']).
+
+    :return:            the number of removed entries.
+    """
+    from morphdepot.models.core import Tombstone
+
+    pool = ThreadPool(threads or config.RAW_DATA['collect_threads'])
+    removed = 0
+    try:
+        for is_dir in (False, True):
+            last = 0
+            while True:
+                batch = session.query(Tombstone) \
+                    .filter(Tombstone.is_dir == is_dir, Tombstone.id > last) \
+                    .order_by(Tombstone.id).limit(batch_size).all()
+                if not batch:
+                    break
+                if is_dir:
+                    entries = [(t.path, True, None) for t in batch]
+                else:
+                    entries = _unreferenced(session, batch)
+                for t, done in zip(batch, pool.map(_remove, entries)):
+                    if done:
+                        session.delete(t)
+                        removed += 1
+                session.commit()
+                last = batch[-1].id
+    finally:
+        pool.close()
+        pool.join()
+    return removed
+
+
+class Collector(threading.Thread):
+    """
+    Background thread that runs collect_tombstones() after every commit of
+    the observed sessions and periodically for tombstones written by other
+    processes.
+    """
+
+    def __init__(self, engine, interval=None):
+        """
+        :param engine:      the engine used by the collector's own sessions.
+        :param interval:    seconds between two periodic runs
+                            (default RAW_DATA['collect_interval']).
+        """
+        super(Collector, self).__init__(name="tombstone collector")
+        self.daemon = True
+        self.engine = engine
+        self.interval = interval or config.RAW_DATA['collect_interval']
+        self.wakeup = threading.Event()
+
+    def observe(self, session):
+        """
+        Wakes the collector after each commit of the given session, or of
+        all sessions of the given sessionmaker.
+        """
+        sa.event.listen(session, 'after_commit', self.notify)
+
+    def notify(self, *args):
+        self.wakeup.set()
+
+    def run(self):
+        Session = orm.sessionmaker(bind=self.engine)
+        while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            session = Session()
+            try:
+                collect_tombstones(session)
+            except Exception:
+                logging.exception("Tombstone collection failed")
+            finally:
+                session.close()
@@ -0,0 +1,121 @@
+"""
+Integrity check of the raw data files against the checksums stored in the
+database.
+
+"""
+from __future__ import division, unicode_literals, print_function
+
+import os
+import datetime as dt
+import multiprocessing
+
+import yaml
+
+import morphdepot.config as config
+from morphdepot.models.core import File
+from morphdepot.rawdata import file_checksum, representation_dir
+
+
+def check_file(task):
+    """
+    Checks a single file. Runs in a worker process of scrub().
+
+    :param task:    a tuple (id, path, checksum, st_size, st_mtime, full, rate).
+
+    :return:        a tuple (id, path, status, detail) where status is one
+                    of 'ok', 'skipped', 'mismatch', 'missing' or 'error'.
+    """
+    id, path, checksum, st_size, st_mtime, full, rate = task
+    try:
+        st = os.stat(path)
+    except OSError as e:
+        return id, path, 'missing', str(e)
+
+    if not full and st.st_size == st_size and st_mtime is not None and \
+            dt.datetime.fromtimestamp(int(st.st_mtime)) == st_mtime.replace(microsecond=0):
+        return id, path, 'skipped', None
+
+    try:
+        actual = file_checksum(path, rate=rate)
+    except (IOError, OSError) as e:
+        return id, path, 'error', str(e)
+
+    if actual != checksum:
+        return id, path, 'mismatch', actual
+    return id, path, 'ok', None
+
+
+def scrub(session, full=False, processes=None, rate=None, checkpoint=None,
+          batch_size=1000):
+    """
+    Compares all files below RAW_DATA['root_dir'] with their stored
+    checksums. Files are hashed in a pool of worker processes. Unless a
+    full scrub is requested, files whose size and modification time match
+    the stored values are skipped.
+
+    :param session:     an open session.
+    :param full:        if True, hash every file.
+    :param processes:   number of worker processes (default SCRUB['processes']).
+    :param rate:        maximum total read rate in MB/s (default SCRUB['rate']),
+                        0 or None means unlimited.
+    :param checkpoint:  path of a checkpoint file. If it exists, the scrub
+                        resumes after the last file recorded there. It is
+                        removed when the scrub is complete.
+    :param batch_size:  number of files fetched and checkpointed at once.
+
+    :return:            a report as dict.
+    """
+    processes = processes or config.SCRUB['processes'] or multiprocessing.cpu_count()
+    rate = rate if rate is not None else config.SCRUB['rate']
+    worker_rate = rate * 1024 * 1024 / processes if rate else None
+
+    state = {'last_id': None, 'report': {
+        'started': dt.datetime.now(), 'finished': None, 'full': full,
+        'checked': 0, 'skipped': 0, 'mismatches': [], 'missing': [], 'errors': []}}
+    if checkpoint and os.path.exists(checkpoint):
+        with open(checkpoint) as f:
+            state = yaml.safe_load(f)
+    report = state['report']
+
+    q = session.query(File.id, File.file_name, File.neuro_representation_id,
+                      File._checksum, File.st_size, File.st_mtime) \
+        .filter(File.status == 'ready').order_by(File.id)
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        while True:
+            batch = q
+            if state['last_id'] is not None:
+                batch = batch.filter(File.id > state['last_id'])
+            tasks = [(str(id), os.path.join(representation_dir(nr_id), name), checksum,
+                      st_size, st_mtime, full, worker_rate)
+                     for id, name, nr_id, checksum, st_size, st_mtime
+                     in batch.limit(batch_size)]
+            if not tasks:
+                break
+
+            for id, path, status, detail in pool.imap(check_file, tasks):
+                if status == 'ok':
+                    report['checked'] += 1
+                elif status == 'skipped':
+                    report['skipped'] += 1
+                elif status == 'mismatch':
+                    report['checked'] += 1
+                    report['mismatches'].append({'id': id, 'path': path, 'checksum': detail})
+                elif status == 'missing':
+                    report['missing'].append({'id': id, 'path': path})
+                else:
+                    report['errors'].append({'id': id, 'path': path, 'error': detail})
+
+            state['last_id'] = tasks[-1][0]
+            if checkpoint:
+                with open(checkpoint, 'w') as f:
+                    yaml.safe_dump(state, f)
+    finally:
+        pool.terminate()
+        pool.join()
+
+    report['finished'] = dt.datetime.now()
+    if checkpoint and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    return report
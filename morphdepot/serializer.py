@@ -1,16 +1,107 @@
 """
-Method(s) to serialize / reconstruct model objects from YAML structures.
+Method(s) to serialize / reconstruct model objects from YAML, JSON or
+MessagePack structures.
 
 """
+import json
+import numbers
+from collections import namedtuple
+
 import yaml
 import sqlalchemy as sa
 
+# MessagePack is optional
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# use the libyaml bindings if available
+try:
+    from yaml import CSafeLoader as SafeLoader, CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeLoader, SafeDumper
+
+
+# names of the columns to serialize / deserialize for a certain model
+Plan = namedtuple('Plan', ['model_name', 'serialize', 'deserialize'])
+
 
 class Serializer(object):
     """
     An abstract class used for parsing YAML -> Python object and vice versa.
     """
 
+    # cache of Plan objects per model class
+    _plans = {}
+
+    @classmethod
+    def plan(cls, model):
+        """
+        Returns the (cached) serialization plan of a model. The plan is
+        computed only once per model, from the columns of its mapper.
+
+        :param model:       a model class
+
+        """
+        plan = cls._plans.get(model)
+        if plan is None:
+            columns = list(model.__mapper__.columns)
+            # do not serialize reserved attributes (see is_serializable),
+            # nor columns that are not available as attribute of the same name
+            plan = Plan(
+                model_name=model.__name__,
+                serialize=tuple(str(c.name) for c in columns
+                                if cls.is_serializable(c) and hasattr(model, c.name)),
+                deserialize=tuple(str(c.name) for c in columns if cls.is_deserializable(c)))
+            cls._plans[model] = plan
+        return plan
+
+    @classmethod
+    def formats(cls):
+        """ names of the available formats, see dumps() and loads() """
+        if msgpack is None:
+            return ['yaml', 'json']
+        return ['yaml', 'json', 'msgpack']
+
+    @classmethod
+    def to_dict(cls, obj, typed=False):
+        """
+        Produces the structure that is serialized for a given object.
+
+        :param obj:         python object to serialize
+        :param typed:       if False all values are converted to strings,
+                            otherwise only those that have no equivalent
+                            in JSON.
+
+        """
+        plan = cls.plan(obj.__class__)
+        attributes = {}
+        for name in plan.serialize:
+            value = getattr(obj, name)
+            if not typed or not (value is None or isinstance(value, numbers.Real)):
+                value = str(value)
+            attributes[name] = value
+
+        return {"attributes": attributes, "model": {"name": plan.model_name}}
+
+    @classmethod
+    def update(cls, obj, data):
+        """
+        Sets the deserializable attributes of an object from a structure as
+        produced by to_dict() or from a flat mapping of attributes.
+
+        :param obj:         object to update
+        :param data:        a dict
+
+        """
+        attributes = data.get("attributes", data)
+        for name in cls.plan(obj.__class__).deserialize:
+            if name in attributes:
+                setattr(obj, name, attributes[name])
+
+        return obj
+
     @classmethod
     def deserialize(cls, model, yaml_string):
         """
@@ -21,16 +112,7 @@ class Serializer(object):
         :param yaml_string: a YAML string representaion of an object
 
         """
-        yaml_obj = yaml.load(yaml_string)
-        obj = model()
-
-        for column in obj.__mapper__.columns:
-            name = column.name
-
-            if name in yaml_obj and cls.is_deserializable(column):
-                setattr(obj, name, yaml_obj[name])
-
-        return obj
+        return cls.update(model(), cls.parse(yaml_string))
 
     @classmethod
     def serialize(cls, obj):
@@ -41,23 +123,40 @@ class Serializer(object):
         :param obj:         python object to serialize
 
         """
-        yaml_obj = {"attributes": {}, "model": {}}
+        return yaml.dump(cls.to_dict(obj), Dumper=SafeDumper)
 
-        yaml_obj["model"]["name"] = obj.__class__.__name__
+    @classmethod
+    def serialize_json(cls, obj):
+        """ like serialize(), but produces JSON """
+        return json.dumps(cls.to_dict(obj, typed=True), sort_keys=True)
 
-        for column in obj.__mapper__.columns:
+    @classmethod
+    def serialize_msgpack(cls, obj):
+        """ like serialize(), but produces MessagePack """
+        return msgpack.packb(cls.to_dict(obj, typed=True), use_bin_type=False)
 
-            if not cls.is_serializable(column):
-                # do not serialize reserved attributes. serialize only 
-                # string-based foreign keys, related to simple dimensions. 
-                # normally these are string-typed
-                continue
+    @classmethod
+    def parse(cls, data, fmt='yaml'):
+        """ parses data in one of the formats() into python structures """
+        if fmt == 'json':
+            return json.loads(data)
+        elif fmt == 'msgpack':
+            return msgpack.unpackb(data, raw=False)
+        return yaml.load(data, Loader=SafeLoader)
 
-            name = column.name
-            if hasattr(obj, name):
-                yaml_obj["attributes"][name] = str(getattr(obj, name))
+    @classmethod
+    def dumps(cls, obj, fmt='yaml'):
+        """ serializes an object in one of the formats() """
+        if fmt == 'json':
+            return cls.serialize_json(obj)
+        elif fmt == 'msgpack':
+            return cls.serialize_msgpack(obj)
+        return cls.serialize(obj)
 
-        return yaml.dump(yaml_obj)
+    @classmethod
+    def loads(cls, model, data, fmt='yaml'):
+        """ deserializes an object from one of the formats() """
+        return cls.update(model(), cls.parse(data, fmt))
 
     @classmethod
     def is_serializable(cls, column):
@@ -78,7 +177,12 @@ class Serializer(object):
         """ with this method one can filter reserved columns """
         foreign_key = len(column.foreign_keys) > 0
 
-        if column.name in ['id', 'mtime', 'ctime', 'dto_type'] or \
+        # the state of the raw data (size, status, checksums) and the
+        # aggregates derived from it are maintained by the flush (see
+        # morphdepot.aggregates), bulk updates of tables would bypass it
+        if column.name in ['id', 'mtime', 'ctime', 'dto_type',
+                           'child_count', 'file_count', 'byte_count',
+                           '_checksum', '_checksum_sum', 'status', 'st_size'] or \
             (foreign_key and not column.type.__class__ == sa.String):
             return False
 
@@ -0,0 +1,385 @@
+"""
+All objects of a model as one table, rendered as CSV or Parquet.
+
+"""
+from __future__ import division, unicode_literals, print_function
+
+import io
+import re
+import csv
+import sys
+import uuid
+import datetime as dt
+
+import sqlalchemy as sa
+
+from morphdepot import cache
+from morphdepot.serializer import Serializer
+from morphdepot.models.core import Scientist, Animal, Experiment, TissueSample, \
+    Protocol, Neuron, NeuroRepresentation, File
+from morphdepot.models.morph import MicroscopeImage, MicroscopeImageStack, Segmentation
+from morphdepot.models.ephys import Electrophysiology
+from morphdepot.models.utils.beanbags import UUID
+
+# Parquet support is optional
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# models that are available as table
+TABLE_MODELS = [Scientist, Animal, Experiment, TissueSample, Protocol, Neuron,
+                NeuroRepresentation, MicroscopeImage, MicroscopeImageStack,
+                Segmentation, Electrophysiology, File]
+
+# rows fetched at once
+YIELD_PER = 1000
+
+# rows compared / updated at once by update()
+UPDATE_BATCH = 500
+
+PY2 = sys.version_info[0] == 2
+
+
+def table_name(model):
+    """
+    The name of the table of a model, e.g. 'tissue_sample' for TissueSample.
+    """
+    return re.sub(r'(?<!^)(?=[A-Z])', '_', model.__name__).lower()
+
+
+def formats():
+    """ names of the available table formats """
+    if pyarrow is None:
+        return ['csv']
+    return ['csv', 'parquet']
+
+
+def rows(session, model):
+    """
+    Streams the serializable columns of all objects of a model, ordered by
+    id, with one query.
+
+    :param session: an open session.
+    :param model:   a model class.
+
+    :return:        the column names and an iterator over the rows.
+    """
+    names = Serializer.plan(model).serialize
+    q = session.query(*[getattr(model, name) for name in names]) \
+        .order_by(model.id).yield_per(YIELD_PER)
+    return names, q
+
+
+def _text(value):
+    if value is None:
+        return ''
+    if isinstance(value, float):
+        # str() rounds floats in Python 2
+        return repr(value)
+    if PY2:
+        if isinstance(value, unicode):
+            return value.encode('utf-8')
+        return str(value)
+    return str(value)
+
+
+def render_csv(session, model):
+    """
+    Renders all objects of a model as CSV with a header line.
+
+    :return:        the CSV document (bytes).
+    """
+    names, q = rows(session, model)
+    if PY2:
+        out = io.BytesIO()
+    else:
+        out = io.StringIO(newline='')
+    writer = csv.writer(out)
+    writer.writerow([_text(n) for n in names])
+    for row in q:
+        writer.writerow([_text(v) for v in row])
+    data = out.getvalue()
+    return data if PY2 else data.encode('utf-8')
+
+
+def _arrow_type(model, name):
+    type = getattr(model, name).property.columns[0].type
+    if isinstance(type, sa.Boolean):
+        return pyarrow.bool_()
+    if isinstance(type, sa.Integer):
+        return pyarrow.int64()
+    if isinstance(type, sa.Float):
+        return pyarrow.float64()
+    if isinstance(type, sa.DateTime):
+        return pyarrow.timestamp('us')
+    return pyarrow.string()
+
+
+def render_parquet(session, model):
+    """
+    Renders all objects of a model as Parquet file, one row group per
+    fetched batch of rows.
+
+    :return:        the Parquet file (bytes).
+    """
+    names, q = rows(session, model)
+    schema = pyarrow.schema([(name, _arrow_type(model, name)) for name in names])
+    out = pyarrow.BufferOutputStream()
+    writer = pyarrow.parquet.ParquetWriter(out, schema)
+
+    def write(batch):
+        arrays = []
+        for field, column in zip(schema, zip(*batch)):
+            if field.type == pyarrow.string():
+                column = [None if v is None else _text(v) for v in column]
+            arrays.append(pyarrow.array(column, field.type))
+        writer.write_table(pyarrow.Table.from_arrays(arrays, schema=schema))
+
+    batch = []
+    for row in q:
+        batch.append(row)
+        if len(batch) == YIELD_PER:
+            write(batch)
+            batch = []
+    if batch:
+        write(batch)
+    writer.close()
+    return out.getvalue().to_pybytes()
+
+
+# rendered tables by (model, format), with the table versions they reflect
+_rendered = {}
+
+
+def render(session, model, fmt='csv'):
+    """
+    Renders a table in one of the formats(). The result is cached until one
+    of the objects of the model changes.
+
+    :return:        the rendered table (bytes).
+    """
+    version = cache.model_version(model)
+    cached = _rendered.get((model, fmt))
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    if fmt == 'parquet':
+        data = render_parquet(session, model)
+    else:
+        data = render_csv(session, model)
+    _rendered[(model, fmt)] = (version, data)
+    return data
+
+
+#-------------------------------------------------------------------------------
+# BULK UPDATES
+#-------------------------------------------------------------------------------
+
+def _read_csv(data):
+    if data.startswith(b'\xef\xbb\xbf'):
+        data = data[3:]
+    if PY2:
+        for row in csv.reader(io.BytesIO(data)):
+            yield [cell.decode('utf-8') for cell in row]
+    else:
+        for row in csv.reader(io.StringIO(data.decode('utf-8'), newline='')):
+            yield row
+
+
+def _datetime(text):
+    for fmt in ('%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d'):
+        try:
+            return dt.datetime.strptime(text, fmt)
+        except ValueError:
+            pass
+    raise ValueError("not a date")
+
+
+def _boolean(text):
+    if text not in ('True', 'False'):
+        raise ValueError("not True or False")
+    return text == 'True'
+
+
+def _parser(column):
+    """ a function that parses a CSV cell for a column """
+    if isinstance(column.type, UUID):
+        return uuid.UUID
+    if isinstance(column.type, sa.Boolean):
+        return _boolean
+    if isinstance(column.type, sa.Integer):
+        return int
+    if isinstance(column.type, sa.Float):
+        return float
+    if isinstance(column.type, sa.DateTime):
+        return _datetime
+    return lambda text: text
+
+
+def update(session, model, data, dry_run=False):
+    """
+    Updates the objects of a model from an edited CSV table as produced by
+    render_csv(). Rows are identified by the 'id' column, rows and columns
+    may be omitted. Values of columns that are not deserializable (see
+    Serializer) are ignored.
+
+    The table is validated first. If there are no errors all changed rows
+    are updated with one batched UPDATE per table in a single transaction,
+    otherwise nothing is changed.
+
+    :param session: an open session.
+    :param model:   a model class.
+    :param data:    the CSV document (bytes).
+    :param dry_run: only validate the table and count the changed rows.
+
+    :return:        the number of updated objects and a list of errors as
+                    (line, message) tuples, line is None for errors that
+                    concern the whole table.
+    """
+    lines = _read_csv(data)
+    try:
+        header = next(lines, None)
+    except (csv.Error, UnicodeDecodeError) as e:
+        return 0, [(1, "invalid CSV: %s" % e)]
+    if header is None or 'id' not in header:
+        return 0, [(1, "there is no 'id' column")]
+
+    plan = Serializer.plan(model)
+    unknown = [name for name in header if name not in plan.serialize]
+    if unknown:
+        return 0, [(1, "unknown columns: %s" % ", ".join(unknown))]
+    if len(set(header)) != len(header):
+        return 0, [(1, "duplicate columns")]
+
+    columns = dict((name, getattr(model, name).property.columns[0])
+                   for name in header if name in plan.deserialize)
+    parsers = dict((name, _parser(c)) for name, c in columns.items())
+    dimensions = dict((name, cache.dimension_of(c)) for name, c in columns.items())
+    id_index = header.index('id')
+
+    # parse and validate all rows
+    errors = []
+    rows = {}
+    line = 1
+    try:
+        for line, row in enumerate(lines, 2):
+            if not any(row):
+                continue
+            if len(row) != len(header):
+                errors.append((line, "expected %i values, got %i" % (len(header), len(row))))
+                continue
+            try:
+                id = uuid.UUID(row[id_index])
+            except ValueError:
+                errors.append((line, "invalid id '%s'" % row[id_index]))
+                continue
+            if id in rows:
+                errors.append((line, "duplicate id %s" % id))
+                continue
+
+            values = {}
+            for name, text in zip(header, row):
+                if name not in columns:
+                    continue
+                if text == '' and (columns[name].nullable or
+                                   not isinstance(columns[name].type, sa.String)):
+                    # an empty string of a required text column is kept
+                    if not columns[name].nullable:
+                        errors.append((line, "%s is required" % name))
+                    values[name] = None
+                    continue
+                try:
+                    values[name] = parsers[name](text)
+                except ValueError as e:
+                    errors.append((line, "invalid %s '%s': %s" % (name, text, e)))
+                    continue
+                dimension = dimensions[name]
+                if dimension is not None and \
+                        values[name] not in cache.dimension_names(session, dimension):
+                    errors.append((line, "unknown %s '%s'" % (name, text)))
+            rows[id] = (line, values)
+    except (csv.Error, UnicodeDecodeError) as e:
+        errors.append((line, "invalid CSV: %s" % e))
+
+    # compare with the stored values, keep only changed rows
+    names = sorted(columns)
+    mappings = []
+    ids = list(rows)
+    now = dt.datetime.now()
+    for i in range(0, len(ids), UPDATE_BATCH):
+        batch = ids[i:i + UPDATE_BATCH]
+        found = set()
+        q = session.query(model.id, *[getattr(model, name) for name in names]) \
+            .filter(model.id.in_(batch))
+        for stored in q:
+            found.add(stored[0])
+            line, values = rows[stored[0]]
+            changed = dict((name, values[name]) for name, value in zip(names, stored[1:])
+                           if values[name] != value)
+            if changed:
+                changed['id'] = stored[0]
+                changed['mtime'] = now
+                mappings.append(changed)
+        for id in batch:
+            if id not in found:
+                errors.append((rows[id][0], "there is no %s with id %s" % (table_name(model), id)))
+
+    if errors:
+        return 0, sorted(errors)
+    if dry_run:
+        return len(mappings), []
+
+    try:
+        session.bulk_update_mappings(model, mappings)
+        # bulk updates bypass the flush events that keep the cache current
+        cache.bump(model, session)
+        session.commit()
+    except sa.exc.SQLAlchemyError as e:
+        session.rollback()
+        return 0, [(None, "update failed: %s" % e)]
+
+    return len(mappings), []
+
+
+def check_roundtrip(session, model):
+    """
+    Renders the table of a model and validates it unchanged as written
+    table, which has to be accepted without changing any row.
+
+    :return:        a list of errors as in update().
+    """
+    count, errors = update(session, model, render_csv(session, model), dry_run=True)
+    if count:
+        errors.append((None, "%i unchanged row(s) would be updated" % count))
+    return errors
+
+
+# error reports of the last update() of a table by model
+_errors = {}
+
+
+def write(session, model, data):
+    """
+    Like update(), but keeps a report of the errors (see errors()).
+
+    :return:        True if the table was updated.
+    """
+    count, errors = update(session, model, data)
+    if errors:
+        report = ''.join(("line %i: %s\n" % (line, message)) if line else (message + "\n")
+                         for line, message in errors)
+        _errors[model] = report.encode('utf-8')
+    else:
+        _errors.pop(model, None)
+    return not errors
+
+
+def errors(model):
+    """
+    The error report of the last failed update of a table or None.
+
+    :return:        the report (bytes).
+    """
+    return _errors.get(model)
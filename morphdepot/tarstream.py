@@ -0,0 +1,131 @@
+"""
+A tar archive that is produced on the fly from in-memory data and files on
+disk, without building the archive itself.
+
+"""
+from __future__ import division, unicode_literals, print_function
+
+import io
+import errno
+import bisect
+import tarfile
+
+BLOCKSIZE = tarfile.BLOCKSIZE
+
+
+class TarStream(object):
+    """
+    Layout of a tar archive as a list of segments. Every segment is either
+    a chunk of bytes (headers, padding, rendered data) or a region of a file
+    on disk, so any range of the archive can be read without producing the
+    preceding data.
+    """
+
+    def __init__(self):
+        self.__starts = []
+        self.__segments = []
+        self.__size = 0
+
+    @property
+    def size(self):
+        """The total size of the archive in bytes"""
+        return self.__size
+
+    def __append(self, length, data=None, path=None):
+        if length > 0:
+            self.__starts.append(self.__size)
+            self.__segments.append((length, data, path))
+            self.__size += length
+
+    def __header(self, name, size, mtime, mode, type):
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mtime = mtime
+        info.mode = mode
+        info.type = type
+        header = info.tobuf(tarfile.GNU_FORMAT, 'utf-8', 'strict')
+        self.__append(len(header), data=header)
+
+    def __padding(self, size):
+        remainder = size % BLOCKSIZE
+        if remainder:
+            self.__append(BLOCKSIZE - remainder, data=b'\0' * (BLOCKSIZE - remainder))
+
+    def add_dir(self, name, mtime=0):
+        """
+        Adds a directory entry.
+
+        :param name:    the path of the directory inside the archive.
+        :param mtime:   modification time as timestamp.
+        """
+        self.__header(name, 0, mtime, 0o755, tarfile.DIRTYPE)
+
+    def add_data(self, name, data, mtime=0):
+        """
+        Adds a file with the given content.
+
+        :param name:    the path of the file inside the archive.
+        :param data:    the content (bytes).
+        :param mtime:   modification time as timestamp.
+        """
+        self.__header(name, len(data), mtime, 0o644, tarfile.REGTYPE)
+        self.__append(len(data), data=data)
+        self.__padding(len(data))
+
+    def add_file(self, name, path, size, mtime=0):
+        """
+        Adds a file on disk, which is read only when the respective part of
+        the archive is read. If the file is larger than the given size (by
+        now) its content is truncated, if it is missing or smaller reading
+        that part fails (see read()).
+
+        :param name:    the path of the file inside the archive.
+        :param path:    the path of the file on disk.
+        :param size:    the size of the file.
+        :param mtime:   modification time as timestamp.
+        """
+        self.__header(name, size, mtime, 0o644, tarfile.REGTYPE)
+        self.__append(size, path=path)
+        self.__padding(size)
+
+    def close(self):
+        """
+        Adds the end-of-archive marker. No members can be added afterwards.
+        """
+        self.__append(2 * BLOCKSIZE, data=b'\0' * (2 * BLOCKSIZE))
+
+    def read(self, size, offset=0):
+        """
+        Reads a part of the archive.
+
+        :param size:    maximum number of bytes to read.
+        :param offset:  the position in the archive.
+
+        :return:        the data (bytes), empty at the end of the archive.
+        :raises IOError: if a file of the archive cannot be read completely,
+                         the archive would be corrupt otherwise.
+        """
+        chunks = []
+        i = bisect.bisect_right(self.__starts, offset) - 1
+        while size > 0 and 0 <= i < len(self.__segments):
+            length, data, path = self.__segments[i]
+            pos = offset - self.__starts[i]
+            n = min(length - pos, size)
+            if path is None:
+                chunk = data[pos:pos + n]
+            else:
+                chunk = self.__read_file(path, pos, n)
+            chunks.append(chunk)
+            offset += n
+            size -= n
+            i += 1
+        return b''.join(chunks)
+
+    @staticmethod
+    def __read_file(path, pos, n):
+        with io.open(path, 'rb') as f:
+            f.seek(pos)
+            chunk = f.read(n)
+        if len(chunk) < n:
+            raise IOError(errno.EIO, "file is shorter than in the archive", path)
+        return chunk